@@ -0,0 +1,356 @@
+from datetime import datetime, UTC
+from typing import Optional, List, Dict, Union, Iterable, Awaitable, AsyncIterator
+import asyncio
+import logging
+import os
+
+from tinkoff.invest import AsyncClient, CandleInterval
+from tinkoff.invest.schemas import EventType, GetBondEventsRequest
+from dotenv import load_dotenv
+
+from utils.converter import SimpleTypeMapper
+from data_collector.historic_data_loader import TinkoffDataLoader, HistoricCandleLoader, GetBondCouponsLoader, \
+                                                GetBondEventsLoader, BOND_EVENT_TYPES
+from data_collector.request_scheduler import AsyncScheduledClient, Priority
+from data_collector.candle_rollup import CandleRollup, ROLLUP_INTERVAL
+from databases.models.tinkoff_db import tinkoffdb_manager, HistoricCandleTable, BondTable, ShareTable, EtfTable, \
+                                        CurrencyTable, FutureTable, BondCouponTable, BondEventTable
+
+
+logger = logging.getLogger(__name__)
+
+INSTRUMENT_TYPES = ['bonds', 'shares', 'etfs', 'currencies', 'futures']
+
+
+async def _as_async_iter(data_iter) -> AsyncIterator:
+    """Обычный или асинхронный итератор ответов как асинхронный"""
+    if hasattr(data_iter, '__aiter__'):
+        async for data in data_iter:
+            yield data
+    else:
+        for data in data_iter:
+            yield data
+
+
+class AsyncTinkoffDataLoader(TinkoffDataLoader):
+    """
+    Асинхронный вариант TinkoffDataLoader на AsyncClient и asyncpg.
+
+    Таблицы, конвертер и планировщик запросов те же, что у синхронных загрузчиков.
+    Методы load у наследников - корутины, запросы по нескольким инструментам
+    выполняются конкурентно, не больше `concurrency` одновременно.
+    Пул соединений свой у каждого event loop: перед выходом из asyncio.run нужно
+    вызвать `await db_manager.dispose_async()`.
+    """
+    concurrency: int = 100
+
+    @classmethod
+    def _getClient(cls, priority: Optional[Priority] = None):
+        if not os.getenv('TOKEN'):
+            raise ValueError("Tinkoff API token not found in environment variables")
+        return AsyncScheduledClient(AsyncClient(os.getenv('TOKEN')), cls.scheduler,
+                                    cls.priority if priority is None else priority)
+
+    @classmethod
+    def _convert(cls, data, additional_fields: Optional[Dict] = None):
+        return SimpleTypeMapper.to_column_types(super()._convert(data, additional_fields))
+
+    @classmethod
+    async def _write_batch(cls, session, rows: List) -> None:
+        await session.execute(cls._insert_statement(), cls._prepare_batch(rows))
+        for statement, params in cls._derived_writes(rows):
+            await session.execute(statement, params)
+
+    @classmethod
+    async def _save(
+            cls,
+            data_iter,
+            additional_fields: Optional[Dict] = None
+    ) -> int:
+        """
+        Сохранение в БД
+
+        Ответы конвертируются и пишутся пачками по pipeline_batch_size по мере чтения итератора,
+        поэтому в памяти держится одна пачка, а не вся история. Транзакция одна на вызов; соединение
+        из пула сессия берёт только при записи первой пачки.
+
+        :param data_iter: Итератор или асинхронный итератор от Tinkoff API
+        :param additional_fields: Дополнительные поля
+        :return: Количество сохранённых строк
+        """
+        count = 0
+        rows = []
+        Session = cls.db_manager.get_async_session()
+        async with Session() as session:
+            try:
+                async for data in _as_async_iter(data_iter):
+                    rows.append(cls._convert(data, additional_fields))
+                    if len(rows) >= cls.pipeline_batch_size:
+                        await cls._write_batch(session, rows)
+                        count += len(rows)
+                        rows = []
+                if rows:
+                    await cls._write_batch(session, rows)
+                    count += len(rows)
+                if count:
+                    for statement, params in cls._final_writes():
+                        await session.execute(statement, params)
+                    await session.commit()
+            except Exception as e:
+                await session.rollback()
+                raise e
+
+        return count
+
+    @classmethod
+    async def _gather(cls, coroutines: Iterable[Awaitable]) -> list:
+        """
+        Конкурентное выполнение, не больше cls.concurrency корутин одновременно
+
+        При ошибке одной корутины остальные отменяются до выхода, поэтому клиент API
+        не закрывается под ещё работающими запросами. Наружу пробрасывается первая ошибка.
+        """
+        semaphore = asyncio.Semaphore(cls.concurrency)
+
+        async def bounded(coroutine):
+            try:
+                async with semaphore:
+                    return await coroutine
+            finally:
+                # Корутина, отменённая до старта, иначе даёт "coroutine was never awaited"
+                coroutine.close()
+
+        try:
+            async with asyncio.TaskGroup() as group:
+                tasks = [group.create_task(bounded(coroutine)) for coroutine in coroutines]
+        except ExceptionGroup as errors:
+            raise errors.exceptions[0]
+        return [task.result() for task in tasks]
+
+
+class AsyncHistoricCandleLoader(AsyncTinkoffDataLoader, HistoricCandleLoader):
+    """Асинхронная загрузка свечей; пишет тем же upsert незавершённых свечей, что HistoricCandleLoader"""
+    db_manager = tinkoffdb_manager
+    table = HistoricCandleTable
+    priority = Priority.INTERACTIVE
+
+    @classmethod
+    async def load(
+            cls,
+            figi: Union[str, List[str]],
+            interval: Union[str, List[str]],
+            from_date: datetime,
+            to_date: datetime,
+            priority: Optional[Priority] = None,
+            refresh_rollups: bool = True
+    ) -> int:
+        """
+        Загрузка свечей в БД
+
+        :param figi: FIGI инструмента
+        :param interval: Интервал свечей (строка или CandleInterval)
+        :param from_date: Начальная дата
+        :param to_date: Конечная дата
+        :param priority: Приоритет запросов (по умолчанию интерактивный)
+        :param refresh_rollups: Пересчитать агрегаты дневных свечей
+        :return: Количество загруженных свечей
+        """
+        figi_list = [figi] if isinstance(figi, str) else figi
+        interval_list = [interval] if isinstance(interval, str) else interval
+
+        try:
+            candle_intervals = {current_interval: CandleInterval[current_interval] for current_interval in interval_list}
+        except KeyError as e:
+            logger.error(f"Invalid CandleInterval value: {str(e)}")
+            raise ValueError(f"Invalid interval value. Details: {str(e)}")
+
+        async with cls._getClient(priority) as client:
+            async def load_one(current_figi: str, current_interval: str) -> int:
+                candles = client.get_all_candles(
+                    instrument_id=current_figi,
+                    from_=from_date,
+                    to=to_date,
+                    interval=candle_intervals[current_interval]
+                )
+                count = await cls._save(
+                    candles,
+                    additional_fields={
+                        'figi': current_figi,
+                        'interval': current_interval
+                    }
+                )
+                logger.info(f"Saved {count} candles for FIGI {current_figi}, interval {current_interval}")
+                return count
+
+            tasks = [(current_figi, current_interval) for current_figi in figi_list for current_interval in interval_list]
+            try:
+                counts = await cls._gather(load_one(current_figi, current_interval)
+                                           for current_figi, current_interval in tasks)
+                # Агрегаты пересчитываются один раз после всех загрузок, а не параллельно на каждый FIGI
+                rollup_figis = [current_figi for (current_figi, current_interval), count in zip(tasks, counts)
+                                if count and current_interval == ROLLUP_INTERVAL]
+                if rollup_figis and refresh_rollups:
+                    await CandleRollup.refresh_async(rollup_figis, from_date, to_date)
+            except Exception as e:
+                logger.error(f"Error loading candles: {str(e)}")
+                raise
+
+        total_candles = sum(counts)
+        logger.info(f"Total candles loaded: {total_candles}")
+        return total_candles
+
+
+class AsyncInstrumentLoader(AsyncTinkoffDataLoader):
+    """Базовый класс для асинхронной загрузки инструментов"""
+
+    @classmethod
+    async def load_instrument(cls, instrument_type: str) -> int:
+        """
+        Загрузка инструментов в БД
+
+        :param instrument_type: Тип инструмента (bonds, shares, etfs, currencies, futures)
+        :return: Количество загруженных инструментов
+        """
+        if instrument_type not in INSTRUMENT_TYPES:
+            raise ValueError(f"Unknown instrument type: {instrument_type}")
+
+        try:
+            async with cls._getClient() as client:
+                instruments = await getattr(client.instruments, instrument_type)()
+
+            response_time = datetime.now(UTC)
+            count = await cls._save(instruments.instruments, additional_fields={'response_time': response_time})
+            logger.info(f"Saved {count} {instrument_type}")
+            return count
+
+        except Exception as e:
+            logger.error(f"Error loading {instrument_type}: {str(e)}")
+            raise
+
+
+class AsyncBondLoader(AsyncInstrumentLoader):
+    db_manager = tinkoffdb_manager
+    table = BondTable
+
+    @classmethod
+    async def load(cls) -> int:
+        """Загрузка облигаций"""
+        return await cls.load_instrument('bonds')
+
+
+class AsyncShareLoader(AsyncInstrumentLoader):
+    db_manager = tinkoffdb_manager
+    table = ShareTable
+
+    @classmethod
+    async def load(cls) -> int:
+        """Загрузка акций"""
+        return await cls.load_instrument('shares')
+
+
+class AsyncEtfLoader(AsyncInstrumentLoader):
+    db_manager = tinkoffdb_manager
+    table = EtfTable
+
+    @classmethod
+    async def load(cls) -> int:
+        """Загрузка ETF"""
+        return await cls.load_instrument('etfs')
+
+
+class AsyncCurrencyLoader(AsyncInstrumentLoader):
+    db_manager = tinkoffdb_manager
+    table = CurrencyTable
+
+    @classmethod
+    async def load(cls) -> int:
+        """Загрузка валют"""
+        return await cls.load_instrument('currencies')
+
+
+class AsyncFutureLoader(AsyncInstrumentLoader):
+    db_manager = tinkoffdb_manager
+    table = FutureTable
+
+    @classmethod
+    async def load(cls) -> int:
+        """Загрузка фьючерсов"""
+        return await cls.load_instrument('futures')
+
+
+class AsyncGetBondCouponsLoader(AsyncTinkoffDataLoader, GetBondCouponsLoader):
+    """Асинхронная загрузка купонов; как и GetBondCouponsLoader, обновляет календарь выплат"""
+    db_manager = tinkoffdb_manager
+    table = BondCouponTable
+
+    @classmethod
+    async def load(cls, figi: Union[str, List[str]], from_date: datetime, to_date: datetime) -> int:
+        figi_list = [figi] if isinstance(figi, str) else figi
+
+        async with cls._getClient() as client:
+            responses = await cls._gather(
+                client.instruments.get_bond_coupons(figi=current_figi, from_=from_date, to=to_date)
+                for current_figi in figi_list
+            )
+
+        response_time = datetime.now(UTC)
+        events = [event for response in responses for event in response.events]
+        count = await cls._save(events, additional_fields={'response_time': response_time})
+        logger.info(f"Saved {count}")
+        return count
+
+
+class AsyncGetBondEventsLoader(AsyncTinkoffDataLoader, GetBondEventsLoader):
+    """Асинхронная загрузка событий с тем же натуральным ключом и upsert, что у GetBondEventsLoader"""
+    db_manager = tinkoffdb_manager
+    table = BondEventTable
+
+    @classmethod
+    async def _get_events(cls, client, figi_list: List[str], from_date: datetime, to_date: datetime) -> list:
+        responses = await cls._gather(
+            client.instruments.get_bond_events(GetBondEventsRequest(from_=from_date, to=to_date, instrument_id=figi,
+                                                                    type=EventType.__getitem__(event_type)))
+            for figi in figi_list
+            for event_type in BOND_EVENT_TYPES
+        )
+        return [event for response in responses for event in response.events]
+
+    @classmethod
+    async def load_by_figi(cls, figi: Union[str, List[str]], from_date: datetime, to_date: datetime) -> int:
+        figi_list = [figi] if isinstance(figi, str) else figi
+        async with cls._getClient() as client:
+            events = await cls._get_events(client, figi_list, from_date, to_date)
+
+        response_time = datetime.now(UTC)
+        count = await cls._save(events, additional_fields={'response_time': response_time})
+        logger.info(f"Saved {count}")
+        return count
+
+    @classmethod
+    async def load(cls, from_date: datetime, to_date: datetime) -> int:
+        # Загрузка по всему списку облигаций - ночная задача, уступает квоту интерактивным запросам
+        async with cls._getClient(Priority.BACKFILL) as client:
+            bonds = await client.instruments.bonds()
+            events = await cls._get_events(client, [bond.figi for bond in bonds.instruments], from_date, to_date)
+
+        response_time = datetime.now(UTC)
+        count = await cls._save(events, additional_fields={'response_time': response_time})
+        logger.info(f"Saved {count}")
+        return count
+
+
+async def __test_load():
+    load_dotenv()
+    try:
+        bond_coupon_from, bond_coupon_to = datetime.strptime('1971/01/01', '%Y/%m/%d'), datetime.strptime('3000/01/01', '%Y/%m/%d')
+        await AsyncHistoricCandleLoader.load(["BBG004730N88"], ['CANDLE_INTERVAL_HOUR'],
+                                             datetime.strptime('2023/01/07', '%Y/%m/%d'),
+                                             datetime.strptime('2023/01/08', '%Y/%m/%d'))
+        await asyncio.gather(AsyncBondLoader.load(), AsyncShareLoader.load(), AsyncEtfLoader.load())
+        await AsyncGetBondCouponsLoader.load(figi='BBG00XH4W3N3', from_date=bond_coupon_from, to_date=bond_coupon_to)
+        await AsyncGetBondEventsLoader.load_by_figi(figi='BBG00XH4W3N3', from_date=bond_coupon_from, to_date=bond_coupon_to)
+    finally:
+        await tinkoffdb_manager.dispose_async()
+
+if __name__ == '__main__':
+    asyncio.run(__test_load())
@@ -0,0 +1,376 @@
+from datetime import datetime, timedelta, UTC
+from typing import Optional, List, Dict, Iterable, Tuple
+import argparse
+import logging
+
+from sqlalchemy import select, update, func, null, case, and_, or_
+from sqlalchemy.dialects.postgresql import insert
+from dotenv import load_dotenv
+
+from data_collector.historic_data_loader import HistoricCandleLoader
+from data_collector.cashflow_calendar import _is_set
+from data_collector.request_scheduler import Priority
+from data_collector.candle_rollup import CandleRollup, ROLLUP_INTERVAL
+from databases.models.tinkoff_db import DatabaseManager, tinkoffdb_manager, HistoricCandleTable, BondTable, ShareTable, \
+                                        EtfTable, FutureTable, BackfillUnitTable
+
+
+logger = logging.getLogger(__name__)
+
+# Максимальный период одного запроса GetCandles для каждого интервала
+INTERVAL_WINDOWS: Dict[str, timedelta] = {
+    'CANDLE_INTERVAL_1_MIN': timedelta(days=1),
+    'CANDLE_INTERVAL_2_MIN': timedelta(days=1),
+    'CANDLE_INTERVAL_3_MIN': timedelta(days=1),
+    'CANDLE_INTERVAL_5_MIN': timedelta(days=1),
+    'CANDLE_INTERVAL_10_MIN': timedelta(days=1),
+    'CANDLE_INTERVAL_15_MIN': timedelta(days=1),
+    'CANDLE_INTERVAL_30_MIN': timedelta(days=2),
+    'CANDLE_INTERVAL_HOUR': timedelta(weeks=1),
+    'CANDLE_INTERVAL_2_HOUR': timedelta(days=30),
+    'CANDLE_INTERVAL_4_HOUR': timedelta(days=30),
+    'CANDLE_INTERVAL_DAY': timedelta(days=365),
+    'CANDLE_INTERVAL_WEEK': timedelta(days=365 * 2),
+    'CANDLE_INTERVAL_MONTH': timedelta(days=365 * 10),
+}
+
+# Разрыв между соседними свечами, начиная с которого считаем, что период не загружен,
+# а не что торгов не было (выходные, праздники, ночь)
+MAX_CANDLE_GAPS: Dict[str, timedelta] = {
+    **{interval: timedelta(days=10) for interval in INTERVAL_WINDOWS},
+    'CANDLE_INTERVAL_WEEK': timedelta(weeks=4),
+    'CANDLE_INTERVAL_MONTH': timedelta(days=100),
+}
+
+# Окна в этих статусах повторно не планируются: выполненные и исчерпавшие попытки
+CLOSED_STATUSES = ('done', 'abandoned')
+
+# Интервалы не меньше дня начинаются с first_1day_candle_date, остальные - с first_1min_candle_date
+DAY_INTERVALS = {'CANDLE_INTERVAL_DAY', 'CANDLE_INTERVAL_WEEK', 'CANDLE_INTERVAL_MONTH'}
+
+INSTRUMENT_TABLES = [ShareTable, BondTable, EtfTable, FutureTable]
+
+WATCHLIST_PRIORITY = 0
+LIQUID_PRIORITY = 10
+DEFAULT_PRIORITY = 20
+
+
+def _as_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """В БД даты хранятся без часового пояса, в UTC"""
+    if value is None or value.tzinfo is not None:
+        return value
+    return value.replace(tzinfo=UTC)
+
+
+def _windows(start: datetime, end: datetime, step: timedelta) -> Iterable[Tuple[datetime, datetime]]:
+    # Окна стыкуются концами; свеча на границе сохраняется один раз благодаря
+    # ON CONFLICT в HistoricCandleLoader
+    while start < end:
+        yield start, min(start + step, end)
+        start += step
+
+
+def _holes(
+        start: datetime,
+        end: datetime,
+        covered: List[Tuple[datetime, datetime]]
+) -> List[Tuple[datetime, datetime]]:
+    """Части [start, end), не покрытые отрезками covered"""
+    holes = []
+    cursor = start
+    for covered_from, covered_to in sorted(covered):
+        if cursor >= end:
+            break
+        if covered_from > cursor:
+            holes.append((cursor, min(covered_from, end)))
+        cursor = max(cursor, covered_to)
+    if cursor < end:
+        holes.append((cursor, end))
+    return holes
+
+
+class BackfillPlanner:
+    """
+    Планировщик загрузки истории свечей.
+
+    По датам первых свечей из таблиц инструментов, уже загруженным в raw.historic_candle периодам
+    и выполненным окнам строит минимальный набор окон запросов и сохраняет их в raw.backfill_unit.
+    Окна выполняются в порядке приоритета и отмечаются как выполненные, поэтому прерванную
+    загрузку можно продолжить. Окно, исчерпавшее max_attempts, получает статус abandoned
+    и возвращается в очередь только через retry_abandoned().
+    """
+    db_manager: DatabaseManager = tinkoffdb_manager
+    loader = HistoricCandleLoader
+    max_attempts: int = 3
+
+    @classmethod
+    def _universe(cls, session, liquid_only: bool, figis: Optional[List[str]]) -> Dict[str, Tuple]:
+        """Последний снимок каждого инструмента: figi -> (first_1min, first_1day, liquidity_flag)"""
+        universe = {}
+        for table in INSTRUMENT_TABLES:
+            liquidity_flag = getattr(table, 'liquidity_flag', null())
+            query = select(
+                table.figi,
+                table.first_1min_candle_date,
+                table.first_1day_candle_date,
+                liquidity_flag.label('liquidity_flag')
+            ).distinct(table.figi).order_by(table.figi, table.response_time.desc())
+            if figis:
+                query = query.where(table.figi.in_(figis))
+            for figi, first_1min, first_1day, liquid in session.execute(query):
+                if liquid_only and not liquid:
+                    continue
+                universe[figi] = (_as_utc(first_1min), _as_utc(first_1day), liquid)
+        return universe
+
+    @classmethod
+    def _coverage(cls, session, intervals: List[str]) -> Dict[Tuple[str, str], List[Tuple[datetime, datetime]]]:
+        """
+        Уже покрытые отрезки: (figi, interval) -> [(from, to)]
+
+        Отрезки - это непрерывные участки загруженных свечей (разрыв больше MAX_CANDLE_GAPS
+        делит участок на два) и закрытые окна прошлых планов, в том числе пустые.
+        """
+        coverage = {}
+        for interval in intervals:
+            candle = HistoricCandleTable
+            previous_time = func.lag(candle.time).over(partition_by=candle.figi, order_by=candle.time)
+            marked = select(
+                candle.figi,
+                candle.time,
+                case((candle.time - previous_time > MAX_CANDLE_GAPS[interval], 1), else_=0).label('new_island')
+            ).where(candle.interval == interval).subquery()
+            islands = select(
+                marked.c.figi,
+                marked.c.time,
+                func.sum(marked.c.new_island).over(partition_by=marked.c.figi, order_by=marked.c.time).label('island')
+            ).subquery()
+            query = select(islands.c.figi, func.min(islands.c.time), func.max(islands.c.time)).group_by(
+                islands.c.figi, islands.c.island)
+            for figi, first, last in session.execute(query):
+                coverage.setdefault((figi, interval), []).append((_as_utc(first), _as_utc(last)))
+
+        units = select(
+            BackfillUnitTable.figi, BackfillUnitTable.interval, BackfillUnitTable.from_date, BackfillUnitTable.to_date
+        ).where(BackfillUnitTable.interval.in_(intervals), BackfillUnitTable.status.in_(CLOSED_STATUSES))
+        for figi, interval, from_date, to_date in session.execute(units):
+            coverage.setdefault((figi, interval), []).append((_as_utc(from_date), _as_utc(to_date)))
+        return coverage
+
+    @classmethod
+    def _is_open(cls):
+        """Условие для окон, которые ещё нужно выполнить"""
+        return or_(
+            BackfillUnitTable.status == 'pending',
+            and_(BackfillUnitTable.status == 'failed', BackfillUnitTable.attempts < cls.max_attempts)
+        )
+
+    @classmethod
+    def retry_abandoned(cls) -> int:
+        """
+        Возвращает в очередь окна, исчерпавшие попытки
+
+        :return: Количество окон, снова ставших pending
+        """
+        Session = cls.db_manager.get_session()
+        with Session() as session:
+            result = session.execute(
+                update(BackfillUnitTable).where(
+                    or_(
+                        BackfillUnitTable.status == 'abandoned',
+                        and_(BackfillUnitTable.status == 'failed', BackfillUnitTable.attempts >= cls.max_attempts)
+                    )
+                ).values(status='pending', attempts=0, updated_time=datetime.now(UTC))
+            )
+            session.commit()
+        logger.info(f"Returned {result.rowcount} abandoned backfill windows to the queue")
+        return result.rowcount
+
+    @classmethod
+    def _unfinished(cls, session) -> set:
+        """Пары (figi, interval), у которых остались невыполненные окна прошлого плана"""
+        query = select(BackfillUnitTable.figi, BackfillUnitTable.interval).where(cls._is_open()).distinct()
+        return set(session.execute(query).all())
+
+    @classmethod
+    def plan(
+            cls,
+            intervals: Optional[List[str]] = None,
+            watchlist: Optional[Iterable[str]] = None,
+            liquid_only: bool = True,
+            figis: Optional[List[str]] = None,
+            to_date: Optional[datetime] = None
+    ) -> int:
+        """
+        Построение плана загрузки истории
+
+        :param intervals: Интервалы свечей, по умолчанию дневные
+        :param watchlist: FIGI, которые загружаются в первую очередь (в том числе неликвидные)
+        :param liquid_only: Только инструменты с liquidity_flag
+        :param figis: Ограничить план этими FIGI
+        :param to_date: Конец истории, по умолчанию начало текущих суток UTC
+        :return: Количество окон в плане
+        """
+        intervals = intervals or ['CANDLE_INTERVAL_DAY']
+        unknown = set(intervals) - INTERVAL_WINDOWS.keys()
+        if unknown:
+            raise ValueError(f"Invalid interval value: {', '.join(sorted(unknown))}")
+
+        watchlist = set(watchlist or [])
+        if to_date is None:
+            to_date = datetime.now(UTC).replace(hour=0, minute=0, second=0, microsecond=0)
+        to_date = _as_utc(to_date)
+        now = datetime.now(UTC)
+
+        Session = cls.db_manager.get_session()
+        with Session() as session:
+            universe = cls._universe(session, liquid_only=liquid_only, figis=figis)
+            if watchlist:
+                watched = cls._universe(session, liquid_only=False, figis=list(watchlist))
+                universe.update(watched)
+            coverage = cls._coverage(session, intervals)
+            unfinished = cls._unfinished(session)
+
+            units = []
+            for figi, (first_1min, first_1day, liquid) in universe.items():
+                if figi in watchlist:
+                    priority = WATCHLIST_PRIORITY
+                elif liquid:
+                    priority = LIQUID_PRIORITY
+                else:
+                    priority = DEFAULT_PRIORITY
+
+                for interval in intervals:
+                    # Прошлый план ещё не выполнен - его окна продолжат загрузку через run()
+                    if (figi, interval) in unfinished:
+                        continue
+                    first_date = first_1day if interval in DAY_INTERVALS else first_1min
+                    # Пустая дата приходит из API как 1970-01-01
+                    if not _is_set(first_date):
+                        continue
+
+                    step = INTERVAL_WINDOWS[interval]
+                    # Участок свечей заканчивается последней свечой, поэтому дыра после него начинается
+                    # с неё же: свеча загрузится повторно и перезапишется, если была неполной
+                    ranges = _holes(first_date, to_date, coverage.get((figi, interval), []))
+
+                    for range_from, range_to in ranges:
+                        for window_from, window_to in _windows(range_from, range_to, step):
+                            units.append({
+                                'figi': figi,
+                                'interval': interval,
+                                'from_date': window_from,
+                                'to_date': window_to,
+                                'priority': priority,
+                                'status': 'pending',
+                                'attempts': 0,
+                                'created_time': now,
+                                'updated_time': now,
+                            })
+
+            if units:
+                # Незакрытое окно с тем же началом могло остаться от прошлого плана: оно снова
+                # становится pending. Выполненные и брошенные окна не трогаем
+                statement = insert(BackfillUnitTable)
+                statement = statement.on_conflict_do_update(
+                    constraint='pk_backfill_unit_figi_interval_from_date',
+                    set_={
+                        'to_date': statement.excluded.to_date,
+                        'priority': statement.excluded.priority,
+                        'status': statement.excluded.status,
+                        'attempts': statement.excluded.attempts,
+                        'error': None,
+                        'updated_time': statement.excluded.updated_time,
+                    },
+                    where=BackfillUnitTable.status.not_in(CLOSED_STATUSES)
+                )
+                session.execute(statement, units)
+            session.commit()
+
+        logger.info(f"Planned {len(units)} backfill windows for {len(universe)} instruments")
+        return len(units)
+
+    @classmethod
+    def pending(cls, session, limit: Optional[int] = None):
+        query = select(BackfillUnitTable).where(cls._is_open()).order_by(BackfillUnitTable.priority, BackfillUnitTable.from_date.desc())
+        if limit is not None:
+            query = query.limit(limit)
+        return session.scalars(query).all()
+
+    @classmethod
+    def estimate_seconds(cls) -> float:
+        """Оценка времени выполнения оставшегося плана при полной квоте market_data"""
+        Session = cls.db_manager.get_session()
+        with Session() as session:
+            units = session.scalar(select(func.count()).select_from(BackfillUnitTable).where(cls._is_open()))
+        return cls.loader.scheduler.estimate_seconds('market_data', units)
+
+    @classmethod
+    def run(cls, limit: Optional[int] = None) -> int:
+        """
+        Выполнение окон плана в порядке приоритета
+
+        :param limit: Максимальное количество окон за запуск
+        :return: Количество загруженных свечей
+        """
+        Session = cls.db_manager.get_session()
+        with Session() as session:
+            units = cls.pending(session, limit)
+            logger.info(f"Running {len(units)} backfill windows, "
+                        f"estimated {cls.loader.scheduler.estimate_seconds('market_data', len(units)):.0f}s")
+
+            total_candles = 0
+            rollup_units = []
+            for unit in units:
+                try:
+                    # Агрегаты пересчитываются один раз после всех окон, а не на каждое окно
+                    count = cls.loader.load(unit.figi, unit.interval, _as_utc(unit.from_date), _as_utc(unit.to_date),
+                                            priority=Priority.BACKFILL, refresh_rollups=False)
+                except Exception as e:
+                    logger.error(f"Backfill window {unit.figi} {unit.interval} {unit.from_date} failed: {str(e)}")
+                    unit.attempts = (unit.attempts or 0) + 1
+                    # Например, делистингованный FIGI: окно больше не выполняется и не планируется
+                    unit.status = 'abandoned' if unit.attempts >= cls.max_attempts else 'failed'
+                    unit.error = str(e)
+                    count = 0
+                else:
+                    unit.attempts = (unit.attempts or 0) + 1
+                    unit.status = 'done'
+                    unit.error = None
+                    unit.candles = count
+                    total_candles += count
+                    if count and unit.interval == ROLLUP_INTERVAL:
+                        rollup_units.append((unit.figi, _as_utc(unit.from_date), _as_utc(unit.to_date)))
+                unit.updated_time = datetime.now(UTC)
+                session.commit()
+
+        if rollup_units:
+            CandleRollup.refresh([figi for figi, _, _ in rollup_units],
+                                 min(from_date for _, from_date, _ in rollup_units),
+                                 max(to_date for _, _, to_date in rollup_units))
+
+        logger.info(f"Backfill loaded {total_candles} candles")
+        return total_candles
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Загрузка истории свечей по ликвидной вселенной")
+    parser.add_argument('--interval', action='append', dest='intervals', choices=sorted(INTERVAL_WINDOWS))
+    parser.add_argument('--watchlist', nargs='*', default=[], help="FIGI, загружаемые в первую очередь")
+    parser.add_argument('--all', action='store_true', help="Включить неликвидные инструменты")
+    parser.add_argument('--limit', type=int, help="Максимальное количество окон за запуск")
+    parser.add_argument('--plan-only', action='store_true')
+    parser.add_argument('--retry-abandoned', action='store_true', help="Вернуть в очередь окна, исчерпавшие попытки")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    if args.retry_abandoned:
+        BackfillPlanner.retry_abandoned()
+    BackfillPlanner.plan(intervals=args.intervals, watchlist=args.watchlist, liquid_only=not args.all)
+    if not args.plan_only:
+        BackfillPlanner.run(limit=args.limit)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+from datetime import datetime, date, timedelta, UTC
+from typing import List, Tuple, Union
+import logging
+
+from sqlalchemy import text
+from dotenv import load_dotenv
+
+from databases.models.tinkoff_db import DatabaseManager, tinkoffdb_manager, CandleRollupDailyTable, CandleRollupWeeklyTable
+
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_INTERVAL = 'CANDLE_INTERVAL_DAY'
+
+# Последний снимок каждого инструмента с сектором, валютой, биржей и лотом.
+# price_scale переводит цену свечи в деньги: у облигаций она в процентах от номинала,
+# у фьючерсов - в пунктах, стоимость пункта min_price_increment_amount / min_price_increment.
+INSTRUMENT_CTE = """
+instrument AS (
+    SELECT DISTINCT ON (figi) figi, coalesce(sector, '') AS sector, coalesce(currency, '') AS currency,
+           coalesce(exchange, '') AS exchange, coalesce(lot, 1) AS lot, price_scale
+    FROM (
+        SELECT figi, sector, currency, exchange, lot, 1.0 AS price_scale, response_time FROM raw.share
+        UNION ALL SELECT figi, sector, currency, exchange, lot, coalesce(nominal_value / 100, 1.0), response_time
+                  FROM raw.bond
+        UNION ALL SELECT figi, sector, currency, exchange, lot, 1.0, response_time FROM raw.etf
+        UNION ALL SELECT figi, sector, currency, exchange, lot,
+                         coalesce(min_price_increment_amount / nullif(min_price_increment, 0), 1.0), response_time
+                  FROM raw.future
+    ) snapshot{instrument_filter}
+    ORDER BY figi, response_time DESC
+)"""
+
+# FIGI всех инструментов из групп (sector, currency, exchange) загруженных инструментов
+GROUP_FIGIS = """
+WITH {instrument_cte}
+SELECT i.figi
+FROM instrument i
+JOIN (SELECT DISTINCT sector, currency, exchange FROM instrument WHERE figi = ANY(:figis)) target
+  ON target.sector = i.sector AND target.currency = i.currency AND target.exchange = i.exchange
+"""
+
+# Фильтры инкрементального пересчёта. Свечи выбираются по FIGI группы, чтобы работал
+# первичный ключ (figi, interval, time), и с запасом в lookback для закрытия предыдущей корзины
+INSTRUMENT_FILTER = """
+    WHERE snapshot.figi = ANY(:group_figis)"""
+
+CANDLE_FILTER = """
+      AND c.figi = ANY(:group_figis) AND c.time >= :from_time AND c.time < :to_time"""
+
+BUCKET_FILTER = """
+WHERE p.bucket_date >= :from_bucket"""
+
+# Доходность и ширина рынка считаются к закрытию предыдущей корзины инструмента,
+# поэтому учитывают гэпы между корзинами
+ROLLUP_INSERT = """
+WITH {instrument_cte},
+bucket AS (
+    SELECT date_trunc('{unit}', c.time)::date AS bucket_date, c.figi,
+           (array_agg(c.close ORDER BY c.time DESC))[1] AS close,
+           sum(c.volume) AS volume,
+           sum(c.close * c.volume) AS value
+    FROM raw.historic_candle c
+    WHERE c.interval = :interval{candle_filter}
+    GROUP BY 1, 2
+),
+per_figi AS (
+    SELECT bucket.*, lag(close) OVER (PARTITION BY figi ORDER BY bucket_date) AS previous_close
+    FROM bucket
+)
+INSERT INTO {table} (bucket_date, sector, currency, exchange, instruments, volume, turnover, avg_return,
+                     advancing, declining, updated_time)
+SELECT p.bucket_date, i.sector, i.currency, i.exchange,
+       count(*), sum(p.volume), sum(p.value * i.lot * i.price_scale),
+       avg(p.close / nullif(p.previous_close, 0) - 1),
+       count(*) FILTER (WHERE p.close > p.previous_close),
+       count(*) FILTER (WHERE p.close < p.previous_close),
+       CAST(:now AS timestamp)
+FROM per_figi p
+JOIN instrument i ON i.figi = p.figi{bucket_filter}
+GROUP BY p.bucket_date, i.sector, i.currency, i.exchange
+ON CONFLICT ON CONSTRAINT {constraint} DO UPDATE SET
+    instruments = excluded.instruments, volume = excluded.volume, turnover = excluded.turnover,
+    avg_return = excluded.avg_return, advancing = excluded.advancing, declining = excluded.declining,
+    updated_time = excluded.updated_time
+"""
+
+ROLLUP_DELETE = """
+WITH {instrument_cte}
+DELETE FROM {table} r
+USING (SELECT DISTINCT sector, currency, exchange FROM instrument) t
+WHERE r.sector = t.sector AND r.currency = t.currency AND r.exchange = t.exchange
+  AND r.bucket_date >= :from_bucket AND r.bucket_date <= :to_bucket
+"""
+
+# Пересчёты агрегатов выполняются по одному: параллельные DELETE + INSERT одной группы
+# в READ COMMITTED не видят строк друг друга
+ROLLUP_LOCK = "SELECT pg_advisory_xact_lock(hashtext('mart.candle_rollup'))"
+
+
+class CandleRollup:
+    """
+    Агрегаты дневных свечей для Superset в mart.candle_rollup_daily / mart.candle_rollup_weekly.
+
+    Корзина - день или неделя по (sector, currency, exchange) последнего снимка инструмента.
+    После загрузки свечей пересчитываются только корзины групп загруженных инструментов
+    в загруженном диапазоне дат, один раз на вызов загрузчика; rebuild() пересчитывает всё.
+    """
+    db_manager: DatabaseManager = tinkoffdb_manager
+    # (таблица, единица date_trunc, длина корзины, запас назад для закрытия предыдущей корзины)
+    rollups: List[Tuple[type, str, timedelta, timedelta]] = [
+        (CandleRollupDailyTable, 'day', timedelta(days=1), timedelta(days=10)),
+        (CandleRollupWeeklyTable, 'week', timedelta(weeks=1), timedelta(weeks=3)),
+    ]
+
+    @staticmethod
+    def _bucket_start(value: datetime, unit: str) -> date:
+        day = value.astimezone(UTC).date() if value.tzinfo else value.date()
+        return day - timedelta(days=day.weekday()) if unit == 'week' else day
+
+    @classmethod
+    def _table_name(cls, table) -> str:
+        return f"{table.__table__.schema}.{table.__tablename__}"
+
+    @classmethod
+    def _fragments(cls, table, unit: str, incremental: bool) -> dict:
+        return {
+            'instrument_cte': INSTRUMENT_CTE.format(instrument_filter=INSTRUMENT_FILTER if incremental else ''),
+            'candle_filter': CANDLE_FILTER if incremental else '',
+            'bucket_filter': BUCKET_FILTER if incremental else '',
+            'table': cls._table_name(table),
+            'constraint': table.__table__.primary_key.name,
+            'unit': unit,
+        }
+
+    @classmethod
+    def group_figis_statement(cls, figi: Union[str, List[str]]) -> Tuple:
+        """Запрос (statement, params) FIGI всех инструментов из групп figi"""
+        statement = text(GROUP_FIGIS.format(instrument_cte=INSTRUMENT_CTE.format(instrument_filter='')))
+        return statement, {'figis': [figi] if isinstance(figi, str) else list(figi)}
+
+    @classmethod
+    def refresh_statements(cls, group_figis: List[str], from_date: datetime, to_date: datetime) -> List[Tuple]:
+        """
+        Запросы (statement, params) пересчёта корзин групп за [from_date, to_date]
+
+        :param group_figis: FIGI всех инструментов пересчитываемых групп (см. group_figis_statement)
+        :param from_date: Начало загруженного диапазона
+        :param to_date: Конец загруженного диапазона
+        """
+        now = datetime.now(UTC).replace(tzinfo=None)
+        statements = [(text(ROLLUP_LOCK), None)]
+        for table, unit, step, lookback in cls.rollups:
+            from_bucket = cls._bucket_start(from_date, unit)
+            # Корзины сразу после диапазона тоже пересчитываются: их доходность считается
+            # к закрытию последней загруженной корзины
+            to_bucket = cls._bucket_start(to_date, unit) + lookback
+            params = {
+                'group_figis': list(group_figis),
+                'interval': ROLLUP_INTERVAL,
+                'from_bucket': from_bucket,
+                'to_bucket': to_bucket,
+                'from_time': datetime.combine(from_bucket, datetime.min.time()) - lookback,
+                'to_time': datetime.combine(to_bucket, datetime.min.time()) + step,
+                'now': now,
+            }
+            fragments = cls._fragments(table, unit, incremental=True)
+            statements.append((text(ROLLUP_DELETE.format(**fragments)), params))
+            statements.append((text(ROLLUP_INSERT.format(**fragments)), params))
+        return statements
+
+    @classmethod
+    def refresh(cls, figi: Union[str, List[str]], from_date: datetime, to_date: datetime):
+        """Инкрементальный пересчёт после загрузки дневных свечей figi"""
+        Session = cls.db_manager.get_session()
+        with Session() as session:
+            group_figis = session.scalars(*cls.group_figis_statement(figi)).all()
+            if not group_figis:
+                return
+            for statement, params in cls.refresh_statements(group_figis, from_date, to_date):
+                session.execute(statement, params)
+            session.commit()
+
+    @classmethod
+    async def refresh_async(cls, figi: Union[str, List[str]], from_date: datetime, to_date: datetime):
+        """refresh для асинхронных загрузчиков"""
+        Session = cls.db_manager.get_async_session()
+        async with Session() as session:
+            group_figis = (await session.scalars(*cls.group_figis_statement(figi))).all()
+            if not group_figis:
+                return
+            for statement, params in cls.refresh_statements(group_figis, from_date, to_date):
+                await session.execute(statement, params)
+            await session.commit()
+
+    @classmethod
+    def rebuild(cls):
+        """Полный пересчёт всех агрегатов"""
+        now = datetime.now(UTC).replace(tzinfo=None)
+        Session = cls.db_manager.get_session()
+        with Session() as session:
+            session.execute(text(ROLLUP_LOCK))
+            for table, unit, _, _ in cls.rollups:
+                fragments = cls._fragments(table, unit, incremental=False)
+                session.execute(text(f"DELETE FROM {cls._table_name(table)}"))
+                session.execute(text(ROLLUP_INSERT.format(**fragments)), {'interval': ROLLUP_INTERVAL, 'now': now})
+            session.commit()
+        logger.info("Candle rollups rebuilt")
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    CandleRollup.rebuild()
@@ -0,0 +1,188 @@
+from datetime import datetime, timedelta, UTC
+from typing import Optional, List, Dict, Iterable, Tuple
+import logging
+
+from sqlalchemy import select, delete, or_
+from sqlalchemy.dialects.postgresql import insert
+from tinkoff.invest.schemas import EventType
+from dotenv import load_dotenv
+
+from utils.converter import SimpleTypeMapper
+from databases.models.tinkoff_db import DatabaseManager, tinkoffdb_manager, row_type, TableRow, CashflowCalendarTable, \
+                                        BondCouponTable, BondEventTable
+
+
+logger = logging.getLogger(__name__)
+
+EVENT_CASHFLOW_TYPES: Dict[str, str] = {
+    'EVENT_TYPE_CPN': 'coupon',
+    'EVENT_TYPE_CALL': 'call',
+    'EVENT_TYPE_MTY': 'maturity',
+    'EVENT_TYPE_CONV': 'conversion',
+}
+
+
+def _event_cashflow_type(event_type) -> Optional[str]:
+    """Тип денежного потока по event_type, сохранённому конвертером как строка enum"""
+    for event_name, cashflow_type in EVENT_CASHFLOW_TYPES.items():
+        if str(event_type) in (event_name, f'EventType.{event_name}', str(EventType[event_name].value)):
+            return cashflow_type
+    return None
+
+
+def _is_set(value: Optional[datetime]) -> bool:
+    # Пустой Timestamp приходит из API как 1970-01-01
+    return value is not None and value.year > 1970
+
+
+def _utcnow() -> datetime:
+    return datetime.now(UTC).replace(tzinfo=None)
+
+
+class CashflowCalendar:
+    """
+    Календарь будущих выплат по облигациям в mart.cashflow_calendar.
+
+    Одна строка на купон, оферту, погашение или конвертацию, индексы по (payment_date, figi)
+    и (figi, payment_date). Загрузчики купонов и событий обновляют календарь в той же
+    транзакции, что и сырые таблицы, поэтому выборка за N дней - это range scan по индексу,
+    а не дедупликация raw.bond_coupon / raw.bond_events по response_time.
+    """
+    db_manager: DatabaseManager = tinkoffdb_manager
+    table = CashflowCalendarTable
+    key = ('figi', 'cashflow_type', 'event_number')
+
+    @classmethod
+    def _row(cls, **values) -> TableRow:
+        return SimpleTypeMapper.to_column_types(row_type(cls.table)(**values))
+
+    @classmethod
+    def from_coupons(cls, rows: Iterable, updated_time: Optional[datetime] = None) -> List[TableRow]:
+        """Строки календаря по строкам raw.bond_coupon (TableRow или ORM)"""
+        updated_time = updated_time or _utcnow()
+        calendar_rows = []
+        for row in rows:
+            calendar_row = cls._row(
+                figi=row.figi,
+                cashflow_type='coupon',
+                event_number=row.coupon_number,
+                payment_date=row.coupon_date,
+                pay_one_bond_value=row.pay_one_bond_value,
+                pay_one_bond_currency=row.pay_one_bond_currency,
+                source='bond_coupon',
+                updated_time=updated_time
+            )
+            calendar_rows.append(calendar_row)
+        return cls._future(calendar_rows)
+
+    @classmethod
+    def from_events(cls, rows: Iterable, updated_time: Optional[datetime] = None) -> List[TableRow]:
+        """Строки календаря по строкам raw.bond_events (TableRow или ORM)"""
+        updated_time = updated_time or _utcnow()
+        calendar_rows = []
+        for row in rows:
+            cashflow_type = _event_cashflow_type(row.event_type)
+            if cashflow_type is None:
+                continue
+            calendar_row = cls._row(
+                figi=row.instrument_id,
+                cashflow_type=cashflow_type,
+                event_number=row.event_number,
+                payment_date=row.pay_date,
+                pay_one_bond_value=row.pay_one_bond_value,
+                pay_one_bond_currency=row.pay_one_bond_currency,
+                source='bond_events',
+                updated_time=updated_time
+            )
+            if not _is_set(calendar_row.payment_date):
+                calendar_row.payment_date = row.event_date
+                SimpleTypeMapper.to_column_types(calendar_row)
+            calendar_rows.append(calendar_row)
+        return cls._future(calendar_rows)
+
+    @classmethod
+    def _future(cls, calendar_rows: List[TableRow]) -> List[TableRow]:
+        now = _utcnow()
+        return [row for row in calendar_rows if _is_set(row.payment_date) and row.payment_date >= now]
+
+    @classmethod
+    def writes(cls, calendar_rows: List[TableRow]) -> List[Tuple]:
+        """Запросы (statement, params) для upsert строк календаря в транзакции загрузчика"""
+        if not calendar_rows:
+            return []
+        unique_rows = {tuple(getattr(row, key) for key in cls.key): row for row in calendar_rows}
+        statement = insert(cls.table.__table__)
+        upsert = statement.on_conflict_do_update(
+            constraint='pk_cashflow_calendar_figi_type_number',
+            set_={
+                column.key: statement.excluded[column.key]
+                for column in cls.table.__table__.columns if column.key not in cls.key
+            }
+        )
+        return [(upsert, [row.as_dict() for row in unique_rows.values()])]
+
+    @classmethod
+    def prune(cls) -> List[Tuple]:
+        """Удаление прошедших выплат; загрузчики выполняют его один раз за сохранение, а не на каждую пачку"""
+        return [(delete(cls.table.__table__).where(cls.table.payment_date < _utcnow()), None)]
+
+    @classmethod
+    def upcoming(
+            cls,
+            days: int,
+            figis: Optional[List[str]] = None,
+            from_date: Optional[datetime] = None
+    ) -> List[CashflowCalendarTable]:
+        """
+        Выплаты в ближайшие `days` дней
+
+        :param days: Длина окна в днях
+        :param figis: FIGI из списка наблюдения или портфеля, по умолчанию все облигации
+        :param from_date: Начало окна (UTC), по умолчанию сейчас
+        :return: Строки календаря, отсортированные по дате выплаты
+        """
+        if from_date is None:
+            from_date = _utcnow()
+        elif from_date.tzinfo is not None:
+            from_date = from_date.astimezone(UTC).replace(tzinfo=None)
+        query = select(CashflowCalendarTable).where(
+            CashflowCalendarTable.payment_date >= from_date,
+            CashflowCalendarTable.payment_date < from_date + timedelta(days=days)
+        ).order_by(CashflowCalendarTable.payment_date, CashflowCalendarTable.figi)
+        if figis is not None:
+            query = query.where(CashflowCalendarTable.figi.in_(figis))
+
+        Session = cls.db_manager.get_session()
+        with Session() as session:
+            return session.scalars(query).all()
+
+    @classmethod
+    def rebuild(cls) -> int:
+        """Полная пересборка календаря из последних ответов raw.bond_coupon и raw.bond_events"""
+        now = _utcnow()
+        latest_coupons = select(BondCouponTable).distinct(
+            BondCouponTable.figi, BondCouponTable.coupon_number
+        ).order_by(
+            BondCouponTable.figi, BondCouponTable.coupon_number, BondCouponTable.response_time.desc()
+        ).where(BondCouponTable.coupon_date >= now)
+        future_events = select(BondEventTable).where(
+            or_(BondEventTable.pay_date >= now, BondEventTable.event_date >= now)
+        )
+
+        Session = cls.db_manager.get_session()
+        with Session() as session:
+            calendar_rows = cls.from_coupons(session.scalars(latest_coupons), now)
+            calendar_rows += cls.from_events(session.scalars(future_events), now)
+            session.execute(delete(cls.table.__table__))
+            for statement, params in cls.writes(calendar_rows):
+                session.execute(statement, params)
+            session.commit()
+
+        logger.info(f"Cashflow calendar rebuilt: {len(calendar_rows)} rows")
+        return len(calendar_rows)
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    CashflowCalendar.rebuild()
@@ -1,11 +1,19 @@
 from datetime import datetime, UTC
+from functools import partial
+import hashlib
 import os
 
+from sqlalchemy import insert, case, and_
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
 from tinkoff.invest import Client, CandleInterval
 from tinkoff.invest.schemas import EventType, GetBondEventsRequest
-from typing import Optional, List, Dict, Union
+from typing import Optional, List, Dict, Union, Tuple
 from utils.converter import SimpleTypeMapper
-from databases.models.tinkoff_db import DatabaseManager, tinkoffdb_manager, Base, HistoricCandleTable, BondTable, ShareTable, EtfTable, \
+from data_collector.request_scheduler import RequestScheduler, ScheduledClient, Priority, tinkoff_scheduler
+from data_collector.pipeline import LoaderPipeline
+from data_collector.cashflow_calendar import CashflowCalendar
+from data_collector.candle_rollup import CandleRollup, ROLLUP_INTERVAL
+from databases.models.tinkoff_db import DatabaseManager, tinkoffdb_manager, Base, row_type, HistoricCandleTable, BondTable, ShareTable, EtfTable, \
                                         CurrencyTable, FutureTable, BondCouponTable, BondEventTable
 from dotenv import load_dotenv
 import logging
@@ -13,9 +21,55 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# EVENT_TYPE_CONV пока не загружаем; EVENT_TYPE_MTY нужен календарю выплат для погашений
+BOND_EVENT_TYPES = ['EVENT_TYPE_UNSPECIFIED', 'EVENT_TYPE_CPN', 'EVENT_TYPE_CALL', 'EVENT_TYPE_MTY']
+
 class TinkoffDataLoader:
     db_manager: DatabaseManager = tinkoffdb_manager
     table: Base
+    scheduler: RequestScheduler = tinkoff_scheduler
+    priority: Priority = Priority.DEFAULT
+    pipeline_converters: int = 2
+    pipeline_queue_size: int = 1000
+    pipeline_batch_size: int = 500
+
+    @classmethod
+    def _convert(cls, data, additional_fields: Optional[Dict] = None):
+        """Преобразование ответа API в компактную строку таблицы (см. row_type)"""
+        table_row = SimpleTypeMapper.convert_row(data, row_type(cls.table))
+
+        if additional_fields:
+            for field, value in additional_fields.items():
+                setattr(table_row, field, value)
+
+        return table_row
+
+    @classmethod
+    def _insert_statement(cls):
+        """INSERT, которым пишутся пачки строк; наследники могут заменить его на upsert"""
+        return insert(cls.table.__table__)
+
+    @classmethod
+    def _prepare_batch(cls, rows: List) -> List[Dict]:
+        """Параметры executemany для пачки строк"""
+        return [row.as_dict() for row in rows]
+
+    @classmethod
+    def _derived_writes(cls, rows: List) -> List[Tuple]:
+        """Запросы (statement, params) для производных таблиц, выполняемые в той же транзакции"""
+        return []
+
+    @classmethod
+    def _final_writes(cls) -> List[Tuple]:
+        """Запросы (statement, params), выполняемые один раз перед коммитом _save"""
+        return []
+
+    @classmethod
+    def _write_batch(cls, session, rows: List) -> None:
+        """Запись пачки строк одним executemany в рамках общей транзакции _save"""
+        session.execute(cls._insert_statement(), cls._prepare_batch(rows))
+        for statement, params in cls._derived_writes(rows):
+            session.execute(statement, params)
 
     @classmethod
     def _save(
@@ -26,43 +80,73 @@ class TinkoffDataLoader:
         """
         Сохранение свечей в БД
 
+        Чтение из API, конвертация и запись идут параллельно через LoaderPipeline,
+        всё сохраняется одной транзакцией.
+
         :param data_iter: Итератор от Tinkoff API
         :param additional_fields: Дополнительные поля
         :return: Количество сохранённых свечей
         """
         Session = cls.db_manager.get_session()
         session = Session()
-        count = 0
+        pipeline = LoaderPipeline(
+            convert=partial(cls._convert, additional_fields=additional_fields),
+            write=partial(cls._write_batch, session),
+            converters=cls.pipeline_converters,
+            queue_size=cls.pipeline_queue_size,
+            batch_size=cls.pipeline_batch_size
+        )
 
         try:
-            for data in data_iter:
-                table_row = SimpleTypeMapper.convert(data, cls.table)
-
-                if additional_fields:
-                    for field, value in additional_fields.items():
-                        setattr(table_row, field, value)
-
-                session.add(table_row)
-                count += 1
-
+            count = pipeline.run(data_iter)
+            for statement, params in cls._final_writes():
+                session.execute(statement, params)
             session.commit()
         except Exception as e:
             session.rollback()
             raise e
         finally:
             session.close()
+            pipeline.log_report(cls.table.__tablename__)
 
         return count
 
-    @staticmethod
-    def _getClient():
+    @classmethod
+    def _getClient(cls, priority: Optional[Priority] = None):
+        """
+        Клиент Tinkoff API, все запросы которого проходят через общий планировщик
+
+        :param priority: Приоритет запросов, по умолчанию приоритет загрузчика
+        """
         if not os.getenv('TOKEN'):
             raise ValueError("Tinkoff API token not found in environment variables")
-        return Client(os.getenv('TOKEN'))
+        return ScheduledClient(Client(os.getenv('TOKEN')), cls.scheduler,
+                               cls.priority if priority is None else priority)
 
 class HistoricCandleLoader(TinkoffDataLoader):
     db_manager = tinkoffdb_manager
     table = HistoricCandleTable
+    priority = Priority.INTERACTIVE
+
+    @classmethod
+    def _insert_statement(cls):
+        # Соседние окна загрузки и повторные загрузки периода возвращают уже сохранённые свечи.
+        # Завершённые свечи не меняются, незавершённые (текущий период) перезаписываются
+        statement = postgresql_insert(cls.table.__table__)
+        return statement.on_conflict_do_update(
+            constraint='pk_historic_candle_figi_interval_time',
+            set_={
+                column.key: statement.excluded[column.key]
+                for column in cls.table.__table__.columns if not column.primary_key
+            },
+            where=cls.table.is_complete.is_not(True)
+        )
+
+    @classmethod
+    def _prepare_batch(cls, rows: List) -> List[Dict]:
+        # ON CONFLICT DO UPDATE не может обновить одну свечу дважды за запрос
+        unique_rows = {(row.figi, row.interval, row.time): row for row in rows}
+        return super()._prepare_batch(list(unique_rows.values()))
 
     @classmethod
     def load(
@@ -70,7 +154,9 @@ class HistoricCandleLoader(TinkoffDataLoader):
             figi: Union[str, List[str]],
             interval: Union[str, List[str]],
             from_date: datetime,
-            to_date: datetime
+            to_date: datetime,
+            priority: Optional[Priority] = None,
+            refresh_rollups: bool = True
     ) -> int:
         """
         Загрузка свечей в БД
@@ -79,6 +165,9 @@ class HistoricCandleLoader(TinkoffDataLoader):
         :param interval: Интервал свечей (строка или CandleInterval)
         :param from_date: Начальная дата
         :param to_date: Конечная дата
+        :param priority: Приоритет запросов (по умолчанию интерактивный)
+        :param refresh_rollups: Пересчитать агрегаты дневных свечей; пакетные загрузки
+            пересчитывают их один раз в конце сами
         :return: Количество загруженных свечей
         """
 
@@ -90,8 +179,9 @@ class HistoricCandleLoader(TinkoffDataLoader):
         interval_list = [interval] if isinstance(interval, str) else interval
 
         total_candles = 0
+        rollup_figis = []
         try:
-            with cls._getClient() as client:
+            with cls._getClient(priority) as client:
                 for current_figi in figi_list:
                     for current_interval in interval_list:
                         logger.info(
@@ -116,6 +206,13 @@ class HistoricCandleLoader(TinkoffDataLoader):
                         total_candles += count
                         logger.info(f"Saved {count} candles for FIGI {current_figi}")
 
+                        if count and current_interval == ROLLUP_INTERVAL:
+                            rollup_figis.append(current_figi)
+
+            # Один пересчёт на все инструменты: у FIGI одной группы корзины общие
+            if rollup_figis and refresh_rollups:
+                CandleRollup.refresh(rollup_figis, from_date, to_date)
+
         except KeyError as e:
             logger.error(f"Invalid CandleInterval value: {str(e)}")
             raise ValueError(f"Invalid interval value. Details: {str(e)}")
@@ -236,6 +333,14 @@ class GetBondCouponsLoader(TinkoffDataLoader):
     db_manager = tinkoffdb_manager
     table = BondCouponTable
 
+    @classmethod
+    def _derived_writes(cls, rows: List) -> List[Tuple]:
+        return CashflowCalendar.writes(CashflowCalendar.from_coupons(rows))
+
+    @classmethod
+    def _final_writes(cls) -> List[Tuple]:
+        return CashflowCalendar.prune()
+
     @classmethod
     def load(cls, figi: str, from_date: datetime, to_date: datetime):
         with cls._getClient() as client:
@@ -248,16 +353,74 @@ class GetBondCouponsLoader(TinkoffDataLoader):
         return count
 
 class GetBondEventsLoader(TinkoffDataLoader):
+    """
+    Загрузка событий по облигациям.
+
+    События хранятся по одному на натуральный ключ: новые вставляются, изменившиеся
+    перезаписываются, у остальных только обновляется last_seen_time.
+    """
     db_manager = tinkoffdb_manager
     table = BondEventTable
+    natural_key = ('instrument_id', 'event_type', 'event_number', 'event_date')
+    # Колонки, которые не входят в хеш содержимого события
+    service_columns = ('response_time', 'content_hash', 'first_seen_time', 'last_seen_time')
+
+    @classmethod
+    def _content_hash(cls, table_row) -> str:
+        content = '\x1f'.join(
+            str(getattr(table_row, key)) for key in table_row.__slots__ if key not in cls.service_columns
+        )
+        return hashlib.md5(content.encode()).hexdigest()
+
+    @classmethod
+    def _convert(cls, data, additional_fields: Optional[Dict] = None):
+        table_row = super()._convert(data, additional_fields)
+        table_row.content_hash = cls._content_hash(table_row)
+        table_row.first_seen_time = table_row.last_seen_time = table_row.response_time
+        return table_row
+
+    @classmethod
+    def _insert_statement(cls):
+        statement = postgresql_insert(cls.table.__table__)
+        # first_seen_time остаётся от первой вставки; response_time меняется только вместе с содержимым
+        changed = cls.table.content_hash.is_distinct_from(statement.excluded.content_hash)
+        updated_columns = {
+            column.key: case((changed, statement.excluded[column.key]), else_=column)
+            for column in cls.table.__table__.columns
+            if column.key not in cls.natural_key + ('id', 'response_time', 'first_seen_time', 'last_seen_time')
+        }
+        # У строк, оставшихся от migrate_bond_events_natural_key, хеша нет: хеш и содержимое
+        # заполняются, но изменением это не считается
+        content_changed = and_(cls.table.content_hash.is_not(None), changed)
+        return statement.on_conflict_do_update(
+            constraint='uq_bond_events_natural_key',
+            set_={
+                **updated_columns,
+                'response_time': case((content_changed, statement.excluded.response_time), else_=cls.table.response_time),
+                'last_seen_time': statement.excluded.last_seen_time
+            }
+        )
+
+    @classmethod
+    def _derived_writes(cls, rows: List) -> List[Tuple]:
+        return CashflowCalendar.writes(CashflowCalendar.from_events(rows))
+
+    @classmethod
+    def _final_writes(cls) -> List[Tuple]:
+        return CashflowCalendar.prune()
+
+    @classmethod
+    def _prepare_batch(cls, rows: List) -> List[Dict]:
+        # ON CONFLICT не может обновить одну строку дважды за запрос, а запросы по типам
+        # событий пересекаются (EVENT_TYPE_UNSPECIFIED возвращает и купоны, и оферты)
+        unique_rows = {tuple(getattr(row, key) for key in cls.natural_key): row for row in rows}
+        return super()._prepare_batch(list(unique_rows.values()))
 
     @classmethod
     def load_by_figi(cls, figi: str, from_date: datetime, to_date: datetime):
         event = []
         with cls._getClient() as client:
-            for event_type in ['EVENT_TYPE_UNSPECIFIED', 'EVENT_TYPE_CPN', 'EVENT_TYPE_CALL']:
-            # for event_type in ['EVENT_TYPE_UNSPECIFIED', 'EVENT_TYPE_CPN', 'EVENT_TYPE_CALL',
-            #              'EVENT_TYPE_MTY', 'EVENT_TYPE_CONV']:
+            for event_type in BOND_EVENT_TYPES:
                 get_bond_request_request = GetBondEventsRequest(from_=from_date, to=to_date, instrument_id=figi,
                                                                 type=EventType.__getitem__(event_type))
                 event += client.instruments.get_bond_events(get_bond_request_request).events
@@ -271,11 +434,10 @@ class GetBondEventsLoader(TinkoffDataLoader):
     @classmethod
     def load(cls, from_date: datetime, to_date: datetime):
         event = []
-        with cls._getClient() as client:
+        # Загрузка по всему списку облигаций - ночная задача, уступает квоту интерактивным запросам
+        with cls._getClient(Priority.BACKFILL) as client:
             for bond in client.instruments.bonds().instruments:
-                for event_type in ['EVENT_TYPE_UNSPECIFIED', 'EVENT_TYPE_CPN', 'EVENT_TYPE_CALL']:
-                    # for event_type in ['EVENT_TYPE_UNSPECIFIED', 'EVENT_TYPE_CPN', 'EVENT_TYPE_CALL',
-                    #              'EVENT_TYPE_MTY', 'EVENT_TYPE_CONV']:
+                for event_type in BOND_EVENT_TYPES:
                     get_bond_request_request = GetBondEventsRequest(from_=from_date, to=to_date, instrument_id=bond.figi,
                                                                     type=EventType.__getitem__(event_type))
                     event += client.instruments.get_bond_events(get_bond_request_request).events
@@ -0,0 +1,249 @@
+from queue import Queue, Empty, Full
+from typing import Optional, List, Dict, Iterable, Callable, Any
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class PipelineCancelled(Exception):
+    """Конвейер остановлен через cancel() или из-за ошибки в другой стадии"""
+
+
+class StageStats:
+    """Статистика одной стадии конвейера"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.busy_seconds = 0.0  # собственная работа стадии (сеть, конвертация, запись)
+        self.blocked_seconds = 0.0  # ожидание входной очереди или места в выходной
+        self.max_queue_depth = 0  # глубина выходной очереди
+        self._queue_depth_sum = 0
+        self._queue_depth_samples = 0
+        self._lock = threading.Lock()
+
+    def record(self, busy: float = 0.0, blocked: float = 0.0, items: int = 0, queue_depth: Optional[int] = None):
+        with self._lock:
+            self.items += items
+            self.busy_seconds += busy
+            self.blocked_seconds += blocked
+            if queue_depth is not None:
+                self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+                self._queue_depth_sum += queue_depth
+                self._queue_depth_samples += 1
+
+    @property
+    def avg_queue_depth(self) -> float:
+        return self._queue_depth_sum / self._queue_depth_samples if self._queue_depth_samples else 0.0
+
+    def throughput(self, elapsed: float) -> float:
+        """Элементов в секунду за время работы конвейера"""
+        return self.items / elapsed if elapsed > 0 else 0.0
+
+    def as_dict(self, elapsed: float) -> Dict[str, float]:
+        return {
+            'items': self.items,
+            'throughput': self.throughput(elapsed),
+            'busy_seconds': self.busy_seconds,
+            'blocked_seconds': self.blocked_seconds,
+            'avg_queue_depth': self.avg_queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+        }
+
+
+class LoaderPipeline:
+    """
+    Конвейер загрузки: producer -> converter workers -> writer.
+
+    Producer читает итератор Tinkoff API в отдельном потоке, конвертеры преобразуют ответы
+    в строки таблицы, writer пишет их пачками в вызывающем потоке (там же, где живёт сессия БД).
+    Стадии связаны очередями ограниченного размера, поэтому медленная запись притормаживает
+    чтение из API, а не копит ответы в памяти. Первая ошибка любой стадии останавливает
+    остальные и пробрасывается из run().
+    """
+
+    def __init__(
+            self,
+            convert: Callable[[Any], Any],
+            write: Callable[[List[Any]], None],
+            converters: int = 2,
+            queue_size: int = 1000,
+            batch_size: int = 500,
+            poll_interval: float = 0.1
+    ):
+        """
+        :param convert: Преобразование ответа API в строку таблицы
+        :param write: Запись пачки строк в БД
+        :param converters: Количество потоков конвертации
+        :param queue_size: Размер каждой очереди между стадиями
+        :param batch_size: Размер пачки для записи
+        """
+        if converters < 1:
+            raise ValueError("Pipeline needs at least one converter")
+        self.convert = convert
+        self.write = write
+        self.converters = converters
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._raw_queue: Queue = Queue(maxsize=queue_size)
+        self._row_queue: Queue = Queue(maxsize=queue_size)
+        self._cancelled = threading.Event()
+        self._error: Optional[BaseException] = None
+        self._error_lock = threading.Lock()
+        self.elapsed = 0.0
+        self.stats: Dict[str, StageStats] = {
+            'producer': StageStats('producer'),
+            'converter': StageStats('converter'),
+            'writer': StageStats('writer'),
+        }
+
+    def cancel(self):
+        """Останавливает все стадии; run() завершится с PipelineCancelled"""
+        self._cancelled.set()
+
+    def _fail(self, error: BaseException):
+        with self._error_lock:
+            if self._error is None:
+                self._error = error
+        self._cancelled.set()
+
+    def _put(self, queue: Queue, item, stats: StageStats):
+        started = time.monotonic()
+        while True:
+            if self._cancelled.is_set():
+                raise PipelineCancelled()
+            try:
+                queue.put(item, timeout=self.poll_interval)
+                break
+            except Full:
+                continue
+        stats.record(blocked=time.monotonic() - started, queue_depth=queue.qsize())
+
+    def _get(self, queue: Queue, stats: StageStats):
+        started = time.monotonic()
+        while True:
+            if self._cancelled.is_set():
+                raise PipelineCancelled()
+            try:
+                item = queue.get(timeout=self.poll_interval)
+                break
+            except Empty:
+                continue
+        stats.record(blocked=time.monotonic() - started)
+        return item
+
+    def _produce(self, source: Iterable):
+        stats = self.stats['producer']
+        try:
+            iterator = iter(source)
+            while True:
+                started = time.monotonic()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                stats.record(busy=time.monotonic() - started, items=1)
+                self._put(self._raw_queue, item, stats)
+            for _ in range(self.converters):
+                self._put(self._raw_queue, _DONE, stats)
+        except PipelineCancelled:
+            pass
+        except BaseException as e:
+            self._fail(e)
+
+    def _convert(self):
+        stats = self.stats['converter']
+        try:
+            while True:
+                item = self._get(self._raw_queue, stats)
+                if item is _DONE:
+                    self._put(self._row_queue, _DONE, stats)
+                    return
+                started = time.monotonic()
+                row = self.convert(item)
+                stats.record(busy=time.monotonic() - started, items=1)
+                self._put(self._row_queue, row, stats)
+        except PipelineCancelled:
+            pass
+        except BaseException as e:
+            self._fail(e)
+
+    def _flush(self, batch: List[Any]):
+        stats = self.stats['writer']
+        started = time.monotonic()
+        self.write(batch)
+        stats.record(busy=time.monotonic() - started, items=len(batch))
+
+    def _write(self) -> int:
+        stats = self.stats['writer']
+        count = 0
+        finished = 0
+        batch = []
+        while finished < self.converters:
+            item = self._get(self._row_queue, stats)
+            if item is _DONE:
+                finished += 1
+                continue
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                self._flush(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            self._flush(batch)
+            count += len(batch)
+        return count
+
+    def run(self, source: Iterable) -> int:
+        """
+        Прогоняет итератор через конвейер
+
+        :param source: Итератор от Tinkoff API
+        :return: Количество записанных строк
+        """
+        started = time.monotonic()
+        threads = [threading.Thread(target=self._produce, args=(source,), name='pipeline-producer', daemon=True)]
+        threads += [threading.Thread(target=self._convert, name=f'pipeline-converter-{i}', daemon=True)
+                    for i in range(self.converters)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            count = self._write()
+        except PipelineCancelled:
+            count = None
+        except BaseException as e:
+            self._fail(e)
+            count = None
+        finally:
+            if self._cancelled.is_set():
+                # producer может висеть в сетевом вызове, поэтому ждём его не дольше poll_interval
+                for thread in threads:
+                    thread.join(timeout=self.poll_interval)
+            else:
+                for thread in threads:
+                    thread.join()
+            self.elapsed = time.monotonic() - started
+
+        if self._error is not None:
+            raise self._error
+        if count is None:
+            raise PipelineCancelled()
+        return count
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        """Статистика по стадиям: количество, пропускная способность, простои и глубина очередей"""
+        return {name: stats.as_dict(self.elapsed) for name, stats in self.stats.items()}
+
+    def log_report(self, title: str):
+        for name, stats in self.report().items():
+            logger.info(
+                f"{title} {name}: {stats['items']} items, {stats['throughput']:.1f}/s, "
+                f"busy {stats['busy_seconds']:.2f}s, blocked {stats['blocked_seconds']:.2f}s, "
+                f"queue avg {stats['avg_queue_depth']:.1f} max {stats['max_queue_depth']}"
+            )
@@ -0,0 +1,332 @@
+from enum import IntEnum
+from typing import Optional, Dict, List, Tuple, Any, Callable
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+from grpc import StatusCode
+from tinkoff.invest.exceptions import RequestError
+
+
+logger = logging.getLogger(__name__)
+
+# Лимиты unary-запросов Tinkoff Invest API в минуту по группам методов
+TINKOFF_UNARY_LIMITS: Dict[str, int] = {
+    'instruments': 200,
+    'market_data': 600,
+    'operations': 200,
+    'users': 100,
+}
+
+# Атрибуты Services (то, что возвращает `with Client(...)`) и их группы лимитов
+SERVICE_GROUPS: Dict[str, str] = {
+    'instruments': 'instruments',
+    'market_data': 'market_data',
+    'operations': 'operations',
+    'users': 'users',
+}
+
+
+class Priority(IntEnum):
+    """Приоритет запроса: чем меньше значение, тем раньше запрос получит квоту"""
+    INTERACTIVE = 0
+    DEFAULT = 10
+    BACKFILL = 20
+
+
+class TokenBucket:
+    """
+    Бюджет запросов одной группы методов.
+
+    Ёмкость и скорость пополнения подобраны так, чтобы в любом окне длиной в минуту
+    было не больше `limit_per_minute` запросов: burst + rate * 60 == limit.
+    После RESOURCE_EXHAUSTED скорость уменьшается вдвое и затем постепенно
+    восстанавливается с каждым успешным запросом.
+    """
+
+    def __init__(self, limit_per_minute: int, burst_fraction: float = 0.1):
+        self.limit_per_minute = limit_per_minute
+        self.capacity = max(1.0, limit_per_minute * burst_fraction)
+        self.max_rate = (limit_per_minute - self.capacity) / 60
+        self.min_rate = self.max_rate / 16
+        self.rate = self.max_rate
+        self.tokens = self.capacity
+        self.paused_until = 0.0
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self._updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Сколько секунд осталось ждать до следующего токена (0 - токен есть)"""
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def penalize(self, now: float, pause: float):
+        self._refill(now)
+        self.tokens = 0.0
+        self.paused_until = max(self.paused_until, now + pause)
+        self._updated = max(self._updated, self.paused_until)
+        self.rate = max(self.min_rate, self.rate / 2)
+
+    def reward(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class RequestScheduler:
+    """
+    Планировщик запросов к Tinkoff API, общий для всех загрузчиков процесса.
+
+    Держит по TokenBucket на группу методов и очередь ожидающих запросов с приоритетами:
+    квоту получает запрос с наименьшим приоритетом, при равенстве - пришедший раньше.
+    """
+
+    def __init__(
+            self,
+            limits: Dict[str, int],
+            max_retries: int = 5,
+            base_backoff: float = 1.0,
+            max_backoff: float = 60.0,
+            poll_interval: float = 0.05
+    ):
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self._buckets: Dict[str, TokenBucket] = {group: TokenBucket(limit) for group, limit in limits.items()}
+        self._waiters: Dict[str, List[Tuple[int, int]]] = {group: [] for group in limits}
+        self._condition = threading.Condition()
+        self._sequence = itertools.count()
+        self.stats: Dict[str, Dict[str, float]] = {
+            group: {'requests': 0, 'exhausted': 0, 'waited_seconds': 0.0} for group in limits
+        }
+
+    def _wait_time(self, group: str, ticket: Tuple[int, int]) -> Optional[float]:
+        """None - запрос не первый в очереди и ждёт уведомления"""
+        if self._waiters[group][0] != ticket:
+            return None
+        return self._buckets[group].wait_time(time.monotonic())
+
+    def _grant(self, group: str):
+        heapq.heappop(self._waiters[group])
+        self._buckets[group].take()
+        self.stats[group]['requests'] += 1
+        self._condition.notify_all()
+
+    def _withdraw(self, group: str, ticket: Tuple[int, int]):
+        waiters = self._waiters[group]
+        if ticket in waiters:
+            waiters.remove(ticket)
+            heapq.heapify(waiters)
+            self._condition.notify_all()
+
+    def acquire(self, group: str, priority: int = Priority.DEFAULT):
+        """
+        Блокирует поток, пока запрос группы `group` не получит квоту
+
+        :param group: Группа методов API (ключ из limits)
+        :param priority: Приоритет запроса (см. Priority)
+        """
+        if group not in self._buckets:
+            raise ValueError(f"Unknown API method group: {group}")
+
+        started = time.monotonic()
+        ticket = (int(priority), next(self._sequence))
+        with self._condition:
+            heapq.heappush(self._waiters[group], ticket)
+            self._condition.notify_all()
+            try:
+                while True:
+                    wait = self._wait_time(group, ticket)
+                    if wait == 0:
+                        self._grant(group)
+                        break
+                    self._condition.wait(wait)
+            except BaseException:
+                self._withdraw(group, ticket)
+                raise
+            self.stats[group]['waited_seconds'] += time.monotonic() - started
+
+    async def acquire_async(self, group: str, priority: int = Priority.DEFAULT):
+        """
+        Асинхронный вариант acquire: ждёт квоту, не блокируя event loop
+
+        Очередь и бюджеты общие с синхронными запросами. Первый в очереди запрос спит ровно
+        до появления токена, остальные периодически проверяют свою очередь.
+        """
+        if group not in self._buckets:
+            raise ValueError(f"Unknown API method group: {group}")
+
+        started = time.monotonic()
+        ticket = (int(priority), next(self._sequence))
+        with self._condition:
+            heapq.heappush(self._waiters[group], ticket)
+            self._condition.notify_all()
+        try:
+            while True:
+                with self._condition:
+                    wait = self._wait_time(group, ticket)
+                    if wait == 0:
+                        self._grant(group)
+                        self.stats[group]['waited_seconds'] += time.monotonic() - started
+                        return
+                await asyncio.sleep(self.poll_interval if wait is None else wait)
+        except BaseException:
+            with self._condition:
+                self._withdraw(group, ticket)
+            raise
+
+    def _backoff(self, error: RequestError, attempt: int) -> float:
+        reset = getattr(error.metadata, 'ratelimit_reset', None)
+        if reset:
+            return float(reset)
+        return min(self.max_backoff, self.base_backoff * 2 ** attempt) * random.uniform(1.0, 1.5)
+
+    def _penalize(self, group: str, pause: float):
+        with self._condition:
+            self._buckets[group].penalize(time.monotonic(), pause)
+            self.stats[group]['exhausted'] += 1
+            self._condition.notify_all()
+
+    def _reward(self, group: str):
+        with self._condition:
+            self._buckets[group].reward()
+
+    def _should_retry(self, group: str, error: RequestError, attempt: int) -> Optional[float]:
+        """Возвращает паузу перед повтором или None, если ошибку надо пробросить"""
+        if error.code != StatusCode.RESOURCE_EXHAUSTED or attempt >= self.max_retries:
+            return None
+        pause = self._backoff(error, attempt)
+        logger.warning(f"Rate limit exhausted for {group}, backing off for {pause:.1f}s (attempt {attempt + 1})")
+        self._penalize(group, pause)
+        return pause
+
+    def call(self, group: str, func: Callable, *args, priority: int = Priority.DEFAULT, **kwargs) -> Any:
+        """
+        Выполняет запрос к API в рамках квоты группы, повторяя его при RESOURCE_EXHAUSTED
+
+        :param group: Группа методов API
+        :param func: Метод сервиса Tinkoff API
+        :param priority: Приоритет запроса
+        :return: Ответ API
+        """
+        attempt = 0
+        while True:
+            self.acquire(group, priority)
+            try:
+                result = func(*args, **kwargs)
+            except RequestError as e:
+                if self._should_retry(group, e, attempt) is None:
+                    raise
+                attempt += 1
+                continue
+            self._reward(group)
+            return result
+
+    async def call_async(self, group: str, func: Callable, *args, priority: int = Priority.DEFAULT, **kwargs) -> Any:
+        """Асинхронный вариант call для методов AsyncClient"""
+        attempt = 0
+        while True:
+            await self.acquire_async(group, priority)
+            try:
+                result = await func(*args, **kwargs)
+            except RequestError as e:
+                if self._should_retry(group, e, attempt) is None:
+                    raise
+                attempt += 1
+                continue
+            self._reward(group)
+            return result
+
+    def estimate_seconds(self, group: str, requests: int) -> float:
+        """Оценка времени выполнения `requests` запросов группы при полной квоте"""
+        bucket = self._buckets[group]
+        return max(0.0, requests - bucket.capacity) / bucket.max_rate
+
+
+class _ScheduledService:
+    """Прокси сервиса Tinkoff API: каждый вызов метода идёт через планировщик"""
+
+    def __init__(self, service, group: str, scheduler: RequestScheduler, priority: int):
+        self._service = service
+        self._group = group
+        self._scheduler = scheduler
+        self._priority = priority
+
+    def __getattr__(self, name):
+        attr = getattr(self._service, name)
+        if not callable(attr):
+            return attr
+
+        def scheduled(*args, **kwargs):
+            return self._scheduler.call(self._group, attr, *args, priority=self._priority, **kwargs)
+        return scheduled
+
+
+class _AsyncScheduledService(_ScheduledService):
+    """Прокси сервиса AsyncClient: методы становятся корутинами, ждущими квоту планировщика"""
+
+    def __getattr__(self, name):
+        attr = getattr(self._service, name)
+        if not callable(attr):
+            return attr
+
+        async def scheduled(*args, **kwargs):
+            return await self._scheduler.call_async(self._group, attr, *args, priority=self._priority, **kwargs)
+        return scheduled
+
+
+class ScheduledClient:
+    """
+    Обёртка над `tinkoff.invest.Client`.
+
+    Подменяет сервисы в объекте, который возвращает `with Client(...)`, на прокси планировщика,
+    поэтому через него проходят и прямые вызовы, и вызовы из хелперов вроде `get_all_candles`.
+    """
+
+    def __init__(self, client, scheduler: RequestScheduler, priority: int = Priority.DEFAULT):
+        self._client = client
+        self._scheduler = scheduler
+        self._priority = priority
+
+    def __enter__(self):
+        services = self._client.__enter__()
+        for attr, group in SERVICE_GROUPS.items():
+            if hasattr(services, attr):
+                setattr(services, attr,
+                        _ScheduledService(getattr(services, attr), group, self._scheduler, self._priority))
+        return services
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return self._client.__exit__(exc_type, exc_val, exc_tb)
+
+
+class AsyncScheduledClient(ScheduledClient):
+    """Обёртка над `tinkoff.invest.AsyncClient`, аналогичная ScheduledClient"""
+
+    async def __aenter__(self):
+        services = await self._client.__aenter__()
+        for attr, group in SERVICE_GROUPS.items():
+            if hasattr(services, attr):
+                setattr(services, attr,
+                        _AsyncScheduledService(getattr(services, attr), group, self._scheduler, self._priority))
+        return services
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return await self._client.__aexit__(exc_type, exc_val, exc_tb)
+
+
+tinkoff_scheduler = RequestScheduler(TINKOFF_UNARY_LIMITS)
@@ -1,31 +1,102 @@
 from sqlalchemy.orm import DeclarativeBase
-from sqlalchemy import create_engine, Column, String, Integer, Float, Boolean, Date, DateTime, PrimaryKeyConstraint, BigInteger
+from sqlalchemy import create_engine, Column, String, Integer, Float, Boolean, Date, DateTime, PrimaryKeyConstraint, BigInteger, \
+                       Index, UniqueConstraint
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import text
+from sqlalchemy.ext import asyncio as sqlalchemy_asyncio
+from sqlalchemy import text, Table
 
+from functools import cache
+from typing import Type
+import asyncio
 import os
 from dotenv import load_dotenv
 
 
 class DatabaseManager:
 
-    def __init__(self, db_name, echo=True):
+    def __init__(self, db_name, echo=True, async_pool_size=20, async_max_overflow=10):
         self.db_name = db_name
         self.echo = echo
+        self.async_pool_size = async_pool_size
+        self.async_max_overflow = async_max_overflow
+        # Соединения asyncpg привязаны к event loop, поэтому движок свой для каждого loop
+        self._async_engines = {}
+
+    def _engine_string(self, driver='postgresql'):
+        return f"{driver}://{os.getenv('postgres_user')}:{os.getenv('postgres_password')}@{os.getenv('postgres_host')}:{os.getenv('postgres_port')}/{self.db_name}"
 
     def create_engine(self):
-        engine_string = f"postgresql://{os.getenv('postgres_user')}:{os.getenv('postgres_password')}@{os.getenv('postgres_host')}:{os.getenv('postgres_port')}/{self.db_name}"
-        return create_engine(engine_string, echo=self.echo)
+        return create_engine(self._engine_string(), echo=self.echo)
 
     def get_session(self):
         """Возвращает новую сессию для работы с БД."""
         return sessionmaker(bind=self.create_engine())
 
+    def create_async_engine(self):
+        return sqlalchemy_asyncio.create_async_engine(
+            self._engine_string('postgresql+asyncpg'),
+            echo=self.echo,
+            pool_size=self.async_pool_size,
+            max_overflow=self.async_max_overflow
+        )
+
+    def get_async_session(self):
+        """
+        Возвращает фабрику асинхронных сессий.
+
+        Вызывается внутри корутины. Движок с пулом соединений создаётся один раз на event loop,
+        перед завершением loop его нужно закрыть через dispose_async().
+        """
+        loop = asyncio.get_running_loop()
+        if loop not in self._async_engines:
+            self._async_engines[loop] = self.create_async_engine()
+        return sqlalchemy_asyncio.async_sessionmaker(bind=self._async_engines[loop], expire_on_commit=False)
+
+    async def dispose_async(self):
+        """Закрывает пул соединений текущего event loop"""
+        engine = self._async_engines.pop(asyncio.get_running_loop(), None)
+        if engine is not None:
+            await engine.dispose()
+
 
 class Base(DeclarativeBase):
     pass
 
+
+class TableRow:
+    """
+    Компактная строка таблицы для пути записи.
+
+    Хранит только значения колонок в __slots__, без инструментовки и identity map ORM.
+    Классы строк создаются по метаданным таблицы через row_type().
+    """
+    __slots__ = ()
+    __table__: Table
+
+    def __init__(self, **kwargs):
+        for key in self.__slots__:
+            setattr(self, key, kwargs.pop(key, None))
+        if kwargs:
+            raise TypeError(f"{', '.join(map(repr, kwargs))} is an invalid keyword argument for {type(self).__name__}")
+
+    def as_dict(self) -> dict:
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{key}={getattr(self, key)!r}' for key in self.__slots__)})"
+
+
+@cache
+def row_type(table: Type[Base]) -> Type[TableRow]:
+    """Класс компактной строки для ORM-таблицы; автоинкрементные ключи заполняет БД"""
+    columns = tuple(
+        column.key for column in table.__table__.columns
+        if not (column.primary_key and column.autoincrement is True)
+    )
+    return type(f"{table.__name__}Row", (TableRow,),
+                {'__slots__': columns, '__table__': table.__table__})
+
 class BondTable(Base):
     __tablename__ = 'bond'
     __table_args__ = (PrimaryKeyConstraint('response_time', 'figi', name='pk_bond_response_time_figi'),
@@ -457,13 +528,18 @@ class BondCouponTable(Base):
 class BondEventTable(Base):
     __tablename__ = 'bond_events'
     __table_args__ = (
+        UniqueConstraint('instrument_id', 'event_type', 'event_number', 'event_date',
+                         name='uq_bond_events_natural_key', postgresql_nulls_not_distinct=True),
         {'schema': 'raw'}
     )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
 
     # Основные идентификаторы
-    response_time = Column(DateTime)
+    response_time = Column(DateTime)  # время последнего изменения события
+    content_hash = Column(String)  # хеш содержимого события без служебных колонок
+    first_seen_time = Column(DateTime)
+    last_seen_time = Column(DateTime)
 
     instrument_id = Column(String)
     event_number = Column(Integer)
@@ -489,6 +565,86 @@ class BondEventTable(Base):
     coupon_period = Column(Integer)
     coupon_interest_rate = Column(Float)  # Для Quotation может потребоваться специальный тип
 
+class CashflowCalendarTable(Base):
+    """Будущие денежные потоки по облигациям: одна строка на купон, оферту, погашение"""
+    __tablename__ = 'cashflow_calendar'
+    __table_args__ = (
+        PrimaryKeyConstraint('figi', 'cashflow_type', 'event_number', name='pk_cashflow_calendar_figi_type_number'),
+        Index('ix_cashflow_calendar_payment_date_figi', 'payment_date', 'figi'),
+        Index('ix_cashflow_calendar_figi_payment_date', 'figi', 'payment_date'),
+        {'schema': 'mart'}
+    )
+
+    figi = Column(String)
+    cashflow_type = Column(String)  # coupon, call, maturity, conversion
+    event_number = Column(Integer)
+    payment_date = Column(DateTime)
+    pay_one_bond_value = Column(Float)
+    pay_one_bond_currency = Column(String)
+    source = Column(String)  # bond_coupon, bond_events
+    updated_time = Column(DateTime)
+
+class CandleRollupDailyTable(Base):
+    """Дневные агрегаты дневных свечей по сектору, валюте и бирже для дашбордов Superset"""
+    __tablename__ = 'candle_rollup_daily'
+    __table_args__ = (
+        PrimaryKeyConstraint('bucket_date', 'sector', 'currency', 'exchange', name='pk_candle_rollup_daily'),
+        {'schema': 'mart'}
+    )
+
+    bucket_date = Column(Date)
+    sector = Column(String)
+    currency = Column(String)
+    exchange = Column(String)
+    instruments = Column(Integer)
+    volume = Column(BigInteger)  # в лотах
+    turnover = Column(Float)  # close * volume * lot в валюте инструмента, у облигаций с учётом номинала
+    avg_return = Column(Float)  # среднее close / предыдущий close - 1 по инструментам
+    advancing = Column(Integer)
+    declining = Column(Integer)
+    updated_time = Column(DateTime)
+
+class CandleRollupWeeklyTable(Base):
+    """Недельные агрегаты (неделя с понедельника), колонки как у CandleRollupDailyTable"""
+    __tablename__ = 'candle_rollup_weekly'
+    __table_args__ = (
+        PrimaryKeyConstraint('bucket_date', 'sector', 'currency', 'exchange', name='pk_candle_rollup_weekly'),
+        {'schema': 'mart'}
+    )
+
+    bucket_date = Column(Date)
+    sector = Column(String)
+    currency = Column(String)
+    exchange = Column(String)
+    instruments = Column(Integer)
+    volume = Column(BigInteger)
+    turnover = Column(Float)
+    avg_return = Column(Float)
+    advancing = Column(Integer)
+    declining = Column(Integer)
+    updated_time = Column(DateTime)
+
+class BackfillUnitTable(Base):
+    """Единица работы загрузки истории свечей: одно окно одного инструмента"""
+    __tablename__ = 'backfill_unit'
+    __table_args__ = (
+        PrimaryKeyConstraint('figi', 'interval', 'from_date', name='pk_backfill_unit_figi_interval_from_date'),
+        Index('ix_backfill_unit_status_priority', 'status', 'priority'),
+        {'schema': 'raw'}
+    )
+
+    figi = Column(String)
+    interval = Column(String)
+    from_date = Column(DateTime)
+    to_date = Column(DateTime)
+    priority = Column(Integer)
+    status = Column(String)  # pending, done, failed, abandoned
+    attempts = Column(Integer)
+    candles = Column(Integer)
+    error = Column(String)
+    created_time = Column(DateTime)
+    updated_time = Column(DateTime)
+
 
 tinkoffdb_manager = DatabaseManager('tinkoff_db')
 
@@ -497,15 +653,60 @@ def create_all_tables():
     """Создает все таблицы в базе данных через метаданные"""
     engine = tinkoffdb_manager.create_engine()
 
-    # Создаем схему raw если она не существует
+    # Создаем схемы raw и mart если они не существуют
     with engine.connect() as conn:
         conn.execute(text("CREATE SCHEMA IF NOT EXISTS raw"))
+        conn.execute(text("CREATE SCHEMA IF NOT EXISTS mart"))
         conn.commit()
 
     # Создаем все таблицы
     Base.metadata.create_all(engine)
     print("Все таблицы успешно созданы")
 
+def migrate_bond_events_natural_key():
+    """
+    Переводит существующую raw.bond_events на натуральный ключ.
+
+    Добавляет колонки first/last seen, оставляет по одной (последней) строке на событие
+    и создаёт уникальный ключ. content_hash у оставшихся строк пустой, его заполнит
+    следующая загрузка событий. Повторный запуск ничего не меняет.
+    """
+    engine = tinkoffdb_manager.create_engine()
+    # Оконные функции вместо self-join по IS NOT DISTINCT FROM: такой join идёт только
+    # вложенным циклом, а PARTITION BY группирует NULL вместе за один проход сортировки
+    ranked = (
+        "SELECT id, row_number() OVER (PARTITION BY instrument_id, event_type, event_number, event_date "
+        "                              ORDER BY response_time DESC NULLS LAST, id DESC) AS rank, "
+        "       min(response_time) OVER (PARTITION BY instrument_id, event_type, event_number, event_date) AS first_seen, "
+        "       max(response_time) OVER (PARTITION BY instrument_id, event_type, event_number, event_date) AS last_seen "
+        "FROM raw.bond_events"
+    )
+    with engine.begin() as conn:
+        conn.execute(text(
+            "ALTER TABLE raw.bond_events "
+            "ADD COLUMN IF NOT EXISTS content_hash varchar, "
+            "ADD COLUMN IF NOT EXISTS first_seen_time timestamp, "
+            "ADD COLUMN IF NOT EXISTS last_seen_time timestamp"
+        ))
+        conn.execute(text(
+            "UPDATE raw.bond_events e SET first_seen_time = ranked.first_seen, last_seen_time = ranked.last_seen "
+            f"FROM ({ranked}) ranked "
+            "WHERE e.id = ranked.id AND ranked.rank = 1 AND e.first_seen_time IS NULL"
+        ))
+        conn.execute(text(
+            f"DELETE FROM raw.bond_events e USING ({ranked}) ranked "
+            "WHERE e.id = ranked.id AND ranked.rank > 1"
+        ))
+        conn.execute(text(
+            "DO $$ BEGIN "
+            "IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'uq_bond_events_natural_key') THEN "
+            "ALTER TABLE raw.bond_events ADD CONSTRAINT uq_bond_events_natural_key "
+            "UNIQUE NULLS NOT DISTINCT (instrument_id, event_type, event_number, event_date); "
+            "END IF; END $$"
+        ))
+    print("raw.bond_events переведена на натуральный ключ")
+
 if __name__ == '__main__':
     load_dotenv()
-    create_all_tables()
\ No newline at end of file
+    create_all_tables()
+    migrate_bond_events_natural_key()
\ No newline at end of file
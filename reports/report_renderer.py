@@ -0,0 +1,222 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, UTC
+from typing import Optional, List, Dict, Tuple, Callable
+from io import BytesIO
+import glob
+import hashlib
+import json
+import logging
+import os
+import time
+
+import matplotlib
+matplotlib.use('Agg')  # без дисплея, рендер только в файлы
+from matplotlib.figure import Figure
+from sqlalchemy import select
+from dotenv import load_dotenv
+
+from databases.models.tinkoff_db import DatabaseManager, tinkoffdb_manager, BondTable, HistoricCandleTable, \
+                                        CashflowCalendarTable
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(__file__), 'cache')
+
+BOND_FIELDS = ['ticker', 'name', 'isin', 'currency', 'nominal_value', 'maturity_date', 'coupon_quantity_per_year',
+               'sector', 'risk_level', 'floating_coupon_flag', 'amortization_flag']
+
+
+def _plain(value):
+    """Значение в виде, пригодном для JSON и pickle"""
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def render_bond_report(payload: Dict) -> Tuple[bytes, Dict[str, float]]:
+    """
+    Картинка отчёта по облигации: график цены, параметры выпуска и ближайшие выплаты
+
+    Выполняется в процессе пула, поэтому принимает и возвращает только простые данные.
+
+    :param payload: Данные отчёта из ReportRenderer.fetch
+    :return: PNG и время стадий рендера
+    """
+    timings = {}
+    started = time.monotonic()
+    figure = Figure(figsize=(10, 7), dpi=100)
+    axes = figure.subplot_mosaic([['chart', 'chart'], ['info', 'cashflows']], height_ratios=[3, 2])
+    chart, info, cashflows = axes['chart'], axes['info'], axes['cashflows']
+    bond = payload['bond']
+    figure.suptitle(f"{bond.get('name') or payload['figi']} ({bond.get('ticker') or payload['figi']})")
+
+    candles = payload['candles']
+    if candles:
+        chart.plot([datetime.fromisoformat(candle['time']) for candle in candles],
+                   [candle['close'] for candle in candles], color='tab:blue')
+        chart.grid(alpha=0.3)
+    else:
+        chart.text(0.5, 0.5, 'Нет дневных свечей', ha='center', va='center', transform=chart.transAxes)
+    chart.set_title('Цена закрытия')
+    timings['chart'] = time.monotonic() - started
+
+    started = time.monotonic()
+    info.axis('off')
+    info.table(cellText=[[field, str(bond.get(field, ''))] for field in BOND_FIELDS if field != 'name'],
+               loc='center', cellLoc='left').scale(1, 1.2)
+    cashflows.axis('off')
+    rows = [[cashflow['payment_date'][:10], cashflow['cashflow_type'],
+             f"{cashflow['pay_one_bond_value'] or ''} {cashflow['pay_one_bond_currency'] or ''}"]
+            for cashflow in payload['cashflows']]
+    if rows:
+        cashflows.table(cellText=rows, colLabels=['Дата', 'Тип', 'На облигацию'], loc='center').scale(1, 1.2)
+    else:
+        cashflows.text(0.5, 0.5, 'Нет будущих выплат', ha='center', va='center')
+    timings['tables'] = time.monotonic() - started
+
+    started = time.monotonic()
+    buffer = BytesIO()
+    figure.savefig(buffer, format='png')
+    timings['encode'] = time.monotonic() - started
+    return buffer.getvalue(), timings
+
+
+# Шаблон -> (функция рендера, версия). Версию нужно поднимать при изменении оформления,
+# иначе в кеше останутся картинки старого вида.
+TEMPLATES: Dict[str, Tuple[Callable[[Dict], Tuple[bytes, Dict[str, float]]], int]] = {
+    'bond': (render_bond_report, 1),
+}
+
+
+class ReportRenderer:
+    """
+    Пакетный рендер отчётов-картинок по облигациям.
+
+    Данные для всех отчётов берутся тремя запросами на весь список FIGI, картинки
+    рендерятся в пуле процессов и кешируются по хешу данных и шаблона: отчёт,
+    у которого не изменились ни данные, ни шаблон, повторно не рендерится. В кеше хранится
+    только последняя картинка каждого FIGI.
+    """
+    db_manager: DatabaseManager = tinkoffdb_manager
+    # По умолчанию REPORT_CACHE_DIR из окружения (читается при рендере, после load_dotenv) или reports/cache
+    cache_dir: Optional[str] = None
+    history_days: int = 365
+    cashflow_limit: int = 12
+
+    @classmethod
+    def fetch(cls, figis: List[str]) -> Dict[str, Dict]:
+        """
+        Данные для отчётов по списку FIGI
+
+        :param figis: FIGI облигаций
+        :return: figi -> данные отчёта (только простые типы)
+        """
+        now = datetime.now(UTC).replace(tzinfo=None)
+        payloads = {figi: {'figi': figi, 'bond': {}, 'candles': [], 'cashflows': []} for figi in figis}
+
+        bonds = select(BondTable).distinct(BondTable.figi).where(BondTable.figi.in_(figis)).order_by(
+            BondTable.figi, BondTable.response_time.desc())
+        candles = select(HistoricCandleTable.figi, HistoricCandleTable.time, HistoricCandleTable.close).where(
+            HistoricCandleTable.figi.in_(figis),
+            HistoricCandleTable.interval == 'CANDLE_INTERVAL_DAY',
+            HistoricCandleTable.time >= now - timedelta(days=cls.history_days)
+        ).order_by(HistoricCandleTable.figi, HistoricCandleTable.time)
+        cashflows = select(CashflowCalendarTable).where(
+            CashflowCalendarTable.figi.in_(figis),
+            CashflowCalendarTable.payment_date >= now
+        ).order_by(CashflowCalendarTable.figi, CashflowCalendarTable.payment_date)
+
+        Session = cls.db_manager.get_session()
+        with Session() as session:
+            for bond in session.scalars(bonds):
+                payloads[bond.figi]['bond'] = {field: _plain(getattr(bond, field)) for field in BOND_FIELDS}
+            for figi, candle_time, close in session.execute(candles):
+                payloads[figi]['candles'].append({'time': _plain(candle_time), 'close': close})
+            for cashflow in session.scalars(cashflows):
+                figi_cashflows = payloads[cashflow.figi]['cashflows']
+                if len(figi_cashflows) < cls.cashflow_limit:
+                    figi_cashflows.append({
+                        'payment_date': _plain(cashflow.payment_date),
+                        'cashflow_type': cashflow.cashflow_type,
+                        'pay_one_bond_value': cashflow.pay_one_bond_value,
+                        'pay_one_bond_currency': cashflow.pay_one_bond_currency,
+                    })
+        return payloads
+
+    @staticmethod
+    def cache_key(payload: Dict, template: str) -> str:
+        _, version = TEMPLATES[template]
+        content = json.dumps({'template': template, 'version': version, 'data': payload}, sort_keys=True, default=str)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    @classmethod
+    def render(
+            cls,
+            figis: List[str],
+            template: str = 'bond',
+            workers: Optional[int] = None
+    ) -> Dict[str, str]:
+        """
+        Рендер отчётов по списку FIGI
+
+        :param figis: FIGI облигаций
+        :param template: Шаблон отчёта из TEMPLATES
+        :param workers: Количество процессов рендера, по умолчанию по числу CPU
+        :return: figi -> путь к картинке
+        """
+        if template not in TEMPLATES:
+            raise ValueError(f"Unknown report template: {template}")
+        render_function, _ = TEMPLATES[template]
+        stats = {'fetch': 0.0, 'hash': 0.0, 'chart': 0.0, 'tables': 0.0, 'encode': 0.0, 'write': 0.0}
+
+        started = time.monotonic()
+        payloads = cls.fetch(figis)
+        stats['fetch'] = time.monotonic() - started
+
+        started = time.monotonic()
+        cache_dir = cls.cache_dir or os.getenv('REPORT_CACHE_DIR', DEFAULT_CACHE_DIR)
+        os.makedirs(cache_dir, exist_ok=True)
+        paths = {}
+        to_render = {}
+        for figi, payload in payloads.items():
+            path = os.path.join(cache_dir, f"{template}_{figi}_{cls.cache_key(payload, template)}.png")
+            paths[figi] = path
+            if not os.path.exists(path):
+                to_render[figi] = payload
+        stats['hash'] = time.monotonic() - started
+
+        if to_render:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(render_function, to_render.values(), chunksize=4)
+                for figi, (image, timings) in zip(to_render, results):
+                    for stage, seconds in timings.items():
+                        stats[stage] += seconds
+                    started = time.monotonic()
+                    # Пишем через временный файл, чтобы в кеше не оказалось недописанной картинки
+                    temporary_path = f"{paths[figi]}.tmp"
+                    with open(temporary_path, 'wb') as file:
+                        file.write(image)
+                    os.replace(temporary_path, paths[figi])
+                    # Окно свечей сдвигается каждый день, поэтому прошлые картинки FIGI больше не понадобятся
+                    stale_pattern = os.path.join(cache_dir, f"{glob.escape(template)}_{glob.escape(figi)}_*.png")
+                    for stale_path in glob.glob(stale_pattern):
+                        if stale_path != paths[figi]:
+                            os.remove(stale_path)
+                    stats['write'] += time.monotonic() - started
+
+        logger.info(
+            f"Rendered {len(to_render)} of {len(payloads)} {template} reports "
+            f"({len(payloads) - len(to_render)} cached); "
+            + ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in stats.items())
+        )
+        return paths
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    Session = tinkoffdb_manager.get_session()
+    with Session() as session:
+        all_figis = session.scalars(select(BondTable.figi).distinct()).all()
+    ReportRenderer.render(all_figis)
@@ -4,6 +4,32 @@ from sqlalchemy.orm import DeclarativeBase
 from plum import dispatch
 from typing import Type, Any, Union
 from tinkoff.invest.utils import quotation_to_decimal, money_to_decimal
+from datetime import datetime, date, UTC
+from decimal import Decimal
+import uuid
+
+from databases.models.tinkoff_db import TableRow
+
+
+def _to_datetime(value) -> datetime:
+    value = value if isinstance(value, datetime) else datetime.fromisoformat(value)
+    # Колонки DateTime без часового пояса, даты хранятся в UTC
+    return value.astimezone(UTC).replace(tzinfo=None) if value.tzinfo else value
+
+
+def _to_date(value) -> date:
+    if isinstance(value, date) and not isinstance(value, datetime):
+        return value
+    return _to_datetime(value).date()
+
+
+_COLUMN_PARSERS = {
+    datetime: _to_datetime,
+    date: _to_date,
+    int: int,
+    float: float,
+    uuid.UUID: lambda value: value if isinstance(value, uuid.UUID) else uuid.UUID(value),
+}
 
 
 class SimpleTypeMapper:
@@ -31,13 +57,50 @@ class SimpleTypeMapper:
         return {attr_name: str(attr_value)}
 
     @classmethod
-    @dispatch
-    def convert(cls, from_obj: _grpc_helpers.Message, to_type: Type[DeclarativeBase]) -> DeclarativeBase:
+    def _attributes(cls, from_obj: _grpc_helpers.Message) -> dict[Any, Any]:
         attributes = {}
         for attr, value in vars(from_obj).items():
             simple_type_attr_dict = cls.to_simple_type(attr, value)
             cls._add_dicts(attributes, simple_type_attr_dict)
-        return to_type(**attributes)
+        return attributes
+
+    @classmethod
+    @dispatch
+    def convert(cls, from_obj: _grpc_helpers.Message, to_type: Type[DeclarativeBase]) -> DeclarativeBase:
+        return to_type(**cls._attributes(from_obj))
+
+    @classmethod
+    def convert_row(cls, from_obj: _grpc_helpers.Message, row_type: type):
+        """Как convert, но в компактную строку (TableRow) вместо ORM-объекта"""
+        return row_type(**cls._attributes(from_obj))
+
+    @classmethod
+    def to_column_types(cls, table_row):
+        """
+        Приводит значения строки к python-типам колонок таблицы.
+
+        convert() отдаёт даты и числа строками, что устраивает psycopg2, но не asyncpg.
+        """
+        # В TableRow нет автоинкрементных ключей, их заполняет БД; у ORM-объекта есть все колонки.
+        # Проверяем тип, а не __slots__: у DeclarativeBase тоже есть пустые __slots__
+        for column in table_row.__table__.columns:
+            if isinstance(table_row, TableRow) and column.key not in table_row.__slots__:
+                continue
+            value = getattr(table_row, column.key)
+            if value is None:
+                continue
+            try:
+                parser = _COLUMN_PARSERS.get(column.type.python_type)
+            except NotImplementedError:
+                parser = None
+            if parser is None:
+                continue
+            if value == 'None':
+                value = None
+            elif isinstance(value, (str, Decimal)) or parser in (_to_datetime, _to_date):
+                value = parser(value)
+            setattr(table_row, column.key, value)
+        return table_row
 
     @classmethod
     def _add_dicts(cls, dict1, dict2):